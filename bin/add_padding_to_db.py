@@ -3,6 +3,9 @@ import numpy
 from experiment_handling import io
 from os import path
 
+# Images are read from the database this many at a time
+READ_BATCH_SIZE = 50
+
 def main():
     from sys import argv
     if len(argv) < 4:
@@ -15,28 +18,35 @@ def main():
 
     experiment_path = path.expanduser(argv[2])
     meta_man = io.MetadataManager(experiment_path)
+    label_map_store = io.LabelMapStore.open_for_experiment(experiment_path)
 
     offset_path = path.expanduser(argv[3])
     offsets = json.load(open(offset_path))
 
-    for i, offset in enumerate(offsets):
-        print "Updating image %d/%d" % (i, len(offsets))
-        key = offset['vsi_path'][2:]
+    with db_man.writer() as writer:
+        for batch_start in xrange(0, len(offsets), READ_BATCH_SIZE):
+            batch = offsets[batch_start:batch_start + READ_BATCH_SIZE]
+            keys = [offset['vsi_path'][2:] for offset in batch]
+
+            # Each batch is read in a single transaction, records are decoded as they're updated
+            records = db_man.get_images(keys, lazy=True)
+
+            for i, (offset, key, record) in enumerate(zip(batch, keys, records), batch_start):
+                print "Updating image %d/%d" % (i, len(offsets))
 
-        try:
-            image = db_man.get_image(key)
-            image.region_map_offset = offset['pad_size']
+                try:
+                    image = record.image
+                    image.region_map_offset = offset['pad_size']
 
-            metadata = meta_man.get_entry_by_attribute('vsiPath', key)
-            region_map = io.load_mhd(path.join(experiment_path, metadata['registeredAtlasLabelsPath']))[0]
-            hemisphere_map = io.load_mhd(path.join(experiment_path, metadata['registeredHemisphereLabelsPath']))[0]
+                    metadata = meta_man.get_entry_by_attribute('vsiPath', key)
+                    region_map, hemisphere_map = io.load_label_maps(metadata, experiment_path, label_map_store)
 
-            image.region_map = numpy.rot90(region_map, k=2)
-            image.hemisphere_map = numpy.rot90(hemisphere_map, k=2)
+                    image.region_map = numpy.rot90(region_map, k=2)
+                    image.hemisphere_map = numpy.rot90(hemisphere_map, k=2)
 
-            db_man.add_image(image)
+                    writer.add_image(image)
 
-        except:
-            print "Failed to update image with key: %s" % key
+                except:
+                    print "Failed to update image with key: %s" % key
 
 main()
@@ -0,0 +1,90 @@
+import time
+from experiment_handling import io
+from argparse import ArgumentParser
+from os import path
+
+
+def configure_parser():
+    parser = ArgumentParser(description='Compares the compression ratio and speed of the record codecs '
+                                        'available to ImageDbManager, on the records in an image database')
+    parser.add_argument('db_path', help='Path to the image database to sample records from')
+    parser.add_argument('-n', '--num_records', type=int, default=50,
+                        help='The number of records to sample from each sub database. Default = 50')
+    parser.add_argument('-c', '--codecs', nargs='+', default=sorted(io.record_codecs),
+                        help='The codecs to benchmark. Defaults to all registered codecs: %s'
+                             % ', '.join(sorted(io.record_codecs)))
+
+    return parser
+
+
+def sample_records(db_path, num_records):
+    """
+    Reads up to num_records decoded records from the main database and each sub database of an ImageDbManager
+
+    Returns a dict mapping database names to lists of records
+    """
+    db_manager = io.ImageDbManager(db_path)
+    sub_dbs = [('cells', db_manager._cells_db), ('crops', db_manager._crops_db), ('maps', db_manager._maps_db)]
+
+    samples = dict()
+    with db_manager._db.begin() as txn:
+        samples['main'] = [io.decode_record(value) for key, value in _take(txn.cursor(), num_records)
+                           if key not in db_manager._sub_db_names]
+
+        for name, db in sub_dbs:
+            if db is not None:
+                samples[name] = [io.decode_record(value) for key, value in _take(txn.cursor(db=db), num_records)]
+
+    return samples
+
+
+def _take(iterable, n):
+    for i, item in enumerate(iterable):
+        if i >= n:
+            break
+        yield item
+
+
+def benchmark_codec(codec, records):
+    """
+    Encodes and decodes records with the named codec
+
+    Returns a tuple (compression ratio, encode MB/s, decode MB/s)
+    """
+    raw_bytes = sum(len(record) for record in records)
+
+    start = time.time()
+    encoded = [io.encode_record(record, codec) for record in records]
+    encode_time = time.time() - start
+
+    start = time.time()
+    for record in encoded:
+        io.decode_record(record)
+    decode_time = time.time() - start
+
+    encoded_bytes = sum(len(record) for record in encoded)
+    megabytes = raw_bytes / 2.0**20
+    return (float(raw_bytes) / encoded_bytes,
+            megabytes / max(encode_time, 1e-9),
+            megabytes / max(decode_time, 1e-9))
+
+
+def main():
+    parser = configure_parser()
+    args = parser.parse_args()
+
+    samples = sample_records(path.expanduser(args.db_path), args.num_records)
+
+    print "%-8s %-8s %8s %10s %12s %12s" % ('db', 'codec', 'records', 'ratio', 'encode MB/s', 'decode MB/s')
+    for db_name in sorted(samples):
+        records = samples[db_name]
+        if not records:
+            continue
+
+        for codec in args.codecs:
+            ratio, encode_speed, decode_speed = benchmark_codec(codec, records)
+            print "%-8s %-8s %8d %10.2f %12.1f %12.1f" % (db_name, codec, len(records), ratio,
+                                                          encode_speed, decode_speed)
+
+if __name__ == '__main__':
+    main()
@@ -73,6 +73,7 @@ def main():
     # Configure io managers for the output database and for the metadata
     db_manager = io.ImageDbManager(args.output_db_path, readonly=False)
     metadata_manager = io.MetadataManager(experiment_path=args.experiment_path)
+    label_map_store = io.LabelMapStore.open_for_experiment(args.experiment_path)
 
     # Configure fish_net.  This will be done internally when CellDetectors are initialized at some point....
     fish_net = caffe.Net(net_path, model_path, caffe.TEST)
@@ -88,32 +89,43 @@ def main():
 
     metadata = metadata_manager.load_metadata()
 
-    for i, image_metadata in enumerate(metadata):
-        print "Analyzing image %d of %d" % (i, len(metadata))
-        try:
-            # Load an image descriptor using an images metadata.  
-            # The experiment path is necessary to locate files that are mentioned in the metadata
-            image_descriptor = data.ImageDescriptor.from_metadata(image_metadata, experiment_path=args.experiment_path)
-
-            # Load the vsi image that the metadata references, and pass it to the cell_detector
-            vsi_path = path.join(args.experiment_path, image_metadata['vsiPath'])
-            vsi_image = load_vsi(vsi_path)
-            vsi_chunker = detection.ImageChunker(vsi_image.transpose(2,0,1), chunk_size=args.chunk_size)
-
-
-            for chunk in vsi_chunker:
-                cell_detector.set_image(chunk.transpose(1,2,0))
-                detected_cells = filter_duplicates(cell_detector.detect_cells(), vsi_chunker.current_chunk_row, vsi_chunker.current_chunk_col, args.chunk_size)
-                image_descriptor.cells += map(lambda cell: data.PhysicalCell.from_cell(cell, VSI_PIXEL_SCALE), detected_cells)
-
-            # Compute and set the offset of the region map
-            vsi_resolution = numpy.asarray(vsi_image.shape[:1], dtype=numpy.int32)
-            image_descriptor.region_map_offset = compute_offset(vsi_resolution)
-
-            # Send the image descriptor to the database
-            db_manager.add_image(image_descriptor)
-        except:
-            print "Cell detection failed for %s" % image_metadata['vsiPath']
+    # Detection takes minutes per image, so each image is committed as soon as it's finished,
+    #  so no finished work is lost if the job is killed
+    with db_manager.writer(max_records=1) as writer:
+        for i, image_metadata in enumerate(metadata):
+            print "Analyzing image %d of %d" % (i, len(metadata))
+            try:
+                # Load an image descriptor using an images metadata.  
+                # The experiment path is necessary to locate files that are mentioned in the metadata
+                image_descriptor = data.ImageDescriptor.from_metadata(image_metadata, experiment_path=args.experiment_path,
+                                                                      label_map_store=label_map_store)
+
+                # Load the vsi image that the metadata references, and pass it to the cell_detector
+                vsi_path = path.join(args.experiment_path, image_metadata['vsiPath'])
+                vsi_image = load_vsi(vsi_path)
+                vsi_chunker = detection.ImageChunker(vsi_image.transpose(2,0,1), chunk_size=args.chunk_size)
+
+
+                for chunk in vsi_chunker:
+                    cell_detector.set_image(chunk.transpose(1,2,0))
+                    detected_cells = filter_duplicates(cell_detector.detect_cells(), vsi_chunker.current_chunk_row, vsi_chunker.current_chunk_col, args.chunk_size)
+                    image_descriptor.cells += map(lambda cell: data.PhysicalCell.from_cell(cell, VSI_PIXEL_SCALE), detected_cells)
+
+                # Compute and set the offset of the region map
+                vsi_resolution = numpy.asarray(vsi_image.shape[:1], dtype=numpy.int32)
+                image_descriptor.region_map_offset = compute_offset(vsi_resolution)
+            except:
+                print "Cell detection failed for %s" % image_metadata['vsiPath']
+                continue
+
+            try:
+                # Send the image descriptor to the database, the writer commits it immediately
+                writer.add_image(image_descriptor)
+            except:
+                print "Could not write the cells detected in %s to the database" % image_metadata['vsiPath']
+
+    print "Committed %d images (%d bytes) in %d transactions" % (
+        writer.committed_records, writer.committed_bytes, writer.commits)
 
 if __name__ == '__main__':
     main()
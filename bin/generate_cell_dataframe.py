@@ -5,13 +5,19 @@ def main():
     from sys import argv
     if len(argv) < 3:
         print "Insufficient Arguments!"
-        print "Proper Usage: %s [image_db_path] [output_csv_path]"
+        print "Proper Usage: %s [image_db_path] [output_csv_path] [(optional) cache_dir]"
         return
 
     db_path, csv_path = map(path.expanduser, argv[1:3])
     
     db_man = io.ImageDbManager(db_path)
-    df = dataframes.get_dataframe_from_image_sequence(db_man.get_image_iter())
+    if len(argv) > 3:
+        # Only images that are new or have changed since the last run are recomputed
+        cache = dataframes.CellTableCache(path.expanduser(argv[3]))
+        df = cache.get_dataframe(db_man)
+        print "Reused %(hits)d cached images, computed %(misses)d images" % cache.get_stats()
+    else:
+        df = dataframes.get_dataframe_from_cell_table_sequence(db_man.get_cell_table_iter())
     df.to_csv(csv_path)
 
 main()
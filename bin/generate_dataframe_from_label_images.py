@@ -2,11 +2,11 @@
 
 import numpy
 import caffe
-import json
 import javabridge
 import bioformats
 from bioformats import log4j
 from experiment_handling import data, conversion, dataframes
+from experiment_handling.io import MetadataManager
 from fisherman import detection, math
 from argparse import ArgumentParser
 from skimage import io, measure
@@ -49,16 +49,12 @@ def get_label_path(vsi_path, args):
     label_name = path.splitext(path.basename(vsi_path))[0] + '_fish_labels.tif'
     return path.join(args.label_dir, label_name)
 
-def get_corresponding_entry(label_path, metadata):
+def get_corresponding_entry(label_path, metadata_manager):
     vsi_name = path.basename(label_path).replace('_fish_labels.tif', '.vsi')
-    for entry in metadata:
-        if vsi_name in entry['vsiPath']:
-            return entry
+    return metadata_manager.get_entry_by_basename(vsi_name)
 
-    return None
-
-def get_image_descriptor(label_path, metadata, args):
-    entry = get_corresponding_entry(label_path, metadata)
+def get_image_descriptor(label_path, metadata_manager, args):
+    entry = get_corresponding_entry(label_path, metadata_manager)
     if entry is None:
         print "Could not locate entry for label path:"
         print label_path
@@ -120,15 +116,14 @@ def main():
     parser = configure_parser()
     args = parser.parse_args()
 
-    metadata_path = path.join(args.experiment_path, '.registrationData', 'metadata.json')
-    metadata = json.load(open(metadata_path))
+    metadata_manager = MetadataManager(args.experiment_path)
 
     javabridge.start_vm(class_path=bioformats.JARS)
     log4j.basic_config()
 
     image_descriptors = ifilter(
         lambda d: d is not None, 
-        (get_image_descriptor(label_path, metadata, args) for label_path in args.image_paths)
+        (get_image_descriptor(label_path, metadata_manager, args) for label_path in args.image_paths)
     )
     df = dataframes.get_dataframe_from_image_sequence(image_descriptors)
     df.to_csv(args.output_path)
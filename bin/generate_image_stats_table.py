@@ -1,29 +1,6 @@
 import pandas
-import numpy
 from os import path
-from experiment_handling import io, allen_atlas, dataframes
-
-
-class StructureAreaMapper:
-
-    def __init__(self, struct_image, root_node):
-        self.area_map = dict()
-        self.struct_image = struct_image
-        self.populate_structure_area_map(root_node)
-
-    def populate_structure_area_map(self, start_node):
-        """
-        Populates an empty dict with a mapping of structure ids to the area of those structures
-            in the self.struct_image
-        """
-        if start_node['children']:
-            map(self.populate_structure_area_map, start_node['children'])
-
-            # We only care about the finest grain structures in this case
-            # self.area_map[start_node['id']] = \
-            #   sum((self.area_map[child['id']] for child in start_node['children']))
-        else:
-            self.area_map[start_node['id']] = numpy.sum(self.struct_image == start_node['id'])
+from experiment_handling import io, allen_atlas, areas, dataframes
 
 
 def main():
@@ -37,14 +14,16 @@ def main():
 
     struct_finder = allen_atlas.StructureFinder(structure_data_path)
     meta_man = io.MetadataManager(experiment_path)
+
+    # Maps are read from the experiment's label map store (see pack_label_maps.py) when it has one
+    label_map_store = io.LabelMapStore.open_for_experiment(experiment_path)
     
     image_stats_table = pandas.DataFrame()
 
     for entry in meta_man.metadata:
         print "Importing data from %s ..." % entry['vsiPath']
         try:
-            region_map = io.load_mhd(path.join(experiment_path, entry['registeredAtlasLabelsPath']))[0]
-            hemisphere_map = io.load_mhd(path.join(experiment_path, entry['registeredHemisphereLabelsPath']))[0]
+            region_map, hemisphere_map = io.load_label_maps(entry, experiment_path, label_map_store)
         except:
             print "Could not load registration results for %s.  Registration probably failed" % entry['vsiPath']
             # It is nice to know which images have been excluded from registration.
@@ -64,39 +43,39 @@ def main():
 
             continue
 
-        for hemisphere in (1, 2):
-            lateral_region_map = region_map * (hemisphere_map == hemisphere)
-            lateral_area_map = StructureAreaMapper(lateral_region_map, struct_finder.structureData).area_map
-            regions, region_areas = zip(*lateral_area_map.iteritems())
-
-            image_names = [path.basename(entry['vsiPath'])] * len(regions)
-            animals = [dataframes.get_animal(entry['vsiPath'])] * len(regions)
-            slides = [dataframes.get_slide(entry['vsiPath'])] * len(regions)
-            conditions = [dataframes.get_class(entry['vsiPath'])] * len(regions)
-            hemispheres = [hemisphere] * len(regions)
-            exclusions = [entry.get('exclude', False)] * len(regions)
-
-            depths = [entry.get('atlasIndex', None)] * len(regions)
-            usabilities = [entry.get('sliceUsable', None)] * len(regions)
-
-            disqualifications = [[region, hemisphere] in entry.get('regionIdsToExclude', []) 
-                                    for region in regions]
-
-            update_df = pandas.DataFrame({
-                'image': image_names,
-                'animal': animals,
-                'slide': slides,
-                'condition': conditions,
-                'depth': depths,
-                'slice_usable': usabilities,
-                'disqualified': disqualifications,
-                'region': regions,
-                'hemisphere': hemispheres,
-                'area': region_areas,
-                'excluded_from_registration': exclusions
-            })
-
-            image_stats_table = pandas.concat((image_stats_table, update_df))
+        # We only care about the finest grain structures in this case
+        area_table = areas.get_area_table(struct_finder, region_map, hemisphere_map, hemispheres=(1, 2),
+                                          rollup=False, leaves_only=True)
+        regions, hemispheres = area_table['region'], area_table['hemisphere']
+
+        image_names = [path.basename(entry['vsiPath'])] * len(regions)
+        animals = [dataframes.get_animal(entry['vsiPath'])] * len(regions)
+        slides = [dataframes.get_slide(entry['vsiPath'])] * len(regions)
+        conditions = [dataframes.get_class(entry['vsiPath'])] * len(regions)
+        exclusions = [entry.get('exclude', False)] * len(regions)
+
+        depths = [entry.get('atlasIndex', None)] * len(regions)
+        usabilities = [entry.get('sliceUsable', None)] * len(regions)
+
+        regions_to_exclude = set(map(tuple, entry.get('regionIdsToExclude', [])))
+        disqualifications = [(region, hemisphere) in regions_to_exclude
+                                for region, hemisphere in zip(regions, hemispheres)]
+
+        update_df = pandas.DataFrame({
+            'image': image_names,
+            'animal': animals,
+            'slide': slides,
+            'condition': conditions,
+            'depth': depths,
+            'slice_usable': usabilities,
+            'disqualified': disqualifications,
+            'region': regions,
+            'hemisphere': hemispheres,
+            'area': area_table['area'],
+            'excluded_from_registration': exclusions
+        })
+
+        image_stats_table = pandas.concat((image_stats_table, update_df))
 
     
     image_stats_table.to_csv(output_path)
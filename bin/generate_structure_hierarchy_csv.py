@@ -8,29 +8,31 @@ def main():
     from sys import argv
     if len(argv) < 3:
         print "Insufficient Arguments!"
-        print "Proper Usage: %s [structure_data_path] [output_csv_path]" % argv[0]
+        print "Proper Usage: %s [structure_data_path] [output_csv_path] [optional: output_npz_path]" % argv[0]
         return
 
-    structure_data_path, output_path = map(path.expanduser, argv[1:])
+    structure_data_path, output_path = map(path.expanduser, argv[1:3])
 
     struct_finder = allen_atlas.StructureFinder(structure_data_path)
     output_file = open(output_path, 'w')
 
     all_structures = struct_finder.get_all_structures_as_list()
 
+    # atlas_id is confusing and useless, children are replaced by child_acronyms
     structure_rows = {key: [structure[key] for structure in all_structures] 
-        for key in all_structures[0].keys() if key != 'atlas_id'} # atlas_id is confusing and useless
-
-    structure_parents = (struct_finder.get_parents_by_attribute('id', id_no) for id_no in structure_rows['id'])
-    parent_acronyms = ((parent['acronym'] for parent in parents) for parents in structure_parents)
-    child_acronyms = ((child['acronym'] for child in children) for children in structure_rows.pop('children'))
+        for key in all_structures[0].keys() if key not in ('atlas_id', 'children')}
 
+    # The hierarchy is computed for every structure in one pass, in the same (pre) order as all_structures
     delim = '\t'
-    structure_rows['parent_acronyms'] = map(delim.join, parent_acronyms)
-    structure_rows['child_acronyms'] = map(delim.join, child_acronyms)
+    hierarchy = struct_finder.get_hierarchy_columns(delimiter=delim)
+    for column in ('parent_acronyms', 'child_acronyms', 'depth', 'path', 'subtree_size'):
+        structure_rows[column] = hierarchy[column]
 
     df = pandas.DataFrame(structure_rows)
     df.to_csv(output_file)
 
+    if len(argv) > 3:
+        struct_finder.write_hierarchy_columns(path.expanduser(argv[3]), delimiter=delim)
+
 
 main()
@@ -1,27 +1,7 @@
 import pandas
 import numpy
 from os import path
-from experiment_handling import io, allen_atlas
-
-class StructureAreaMapper:
-
-    def __init__(self, struct_image, root_node):
-        self.area_map = dict()
-        self.struct_image = struct_image
-        self.populate_structure_area_map(root_node)
-
-    def populate_structure_area_map(self, start_node):
-        """
-        Populates an empty dict with a mapping of structure ids to 
-        """
-        if start_node['children']:
-            map(self.populate_structure_area_map, start_node['children'])
-            self.area_map[start_node['id']] = \
-                sum((self.area_map[child['id']] for child in start_node['children'])) + \
-                numpy.sum(self.struct_image == start_node['id'])
-        else:
-            self.area_map[start_node['id']] = numpy.sum(self.struct_image == start_node['id'])
-
+from experiment_handling import io, allen_atlas, areas
 
 def main():
     from sys import argv
@@ -33,24 +13,18 @@ def main():
     structure_data_path, structure_mhd_path, output_path = map(path.expanduser, argv[1:4])
     
     struct_finder = allen_atlas.StructureFinder(structure_data_path)
-    struct_image = io.load_mhd(structure_mhd_path)[0]
-   
-    # The second argment to numpy.split indictes the indicies to split at, so we exclude 0
-    area_maps = [StructureAreaMapper(image, struct_finder.structureData).area_map 
-        for image in numpy.split(struct_image, range(1, struct_image.shape[0]))]
-
-    structure_size_table = pandas.DataFrame()
-
-    for depth, area_map in enumerate(area_maps):
-        regions, region_areas = zip(*area_map.iteritems())
-        depths = [depth] * len(regions)
-        slice_df = pandas.DataFrame({
-            'depth': depths,
-            'region': regions,
-            'area': region_areas
-        })
 
-        structure_size_table = pandas.concat((structure_size_table, slice_df))
+    # The volume is streamed from disk, so memory use doesn't depend on it's size
+    struct_image = io.load_mhd(structure_mhd_path, mmap_mode='r')[0]
+    depth_areas = areas.count_label_areas_by_depth(struct_finder, struct_image, depth_axis=0)
+    depth_areas = areas.rollup_areas(struct_finder, depth_areas)
+
+    num_depths, num_regions = depth_areas.shape
+    structure_size_table = pandas.DataFrame({
+        'depth': numpy.repeat(numpy.arange(num_depths), num_regions),
+        'region': numpy.tile(struct_finder.get_all_ids(), num_depths),
+        'area': depth_areas.ravel()
+    })
 
     structure_size_table.to_csv(output_path)
 
@@ -47,12 +47,12 @@ counts = {image_class: dict() for image_class in classes}
 counts[None] = dict()
 
 
-def get_class(desc):
+def get_class(source_path):
     for class_tag in classes:
-        if class_tag in desc.source_path:
+        if class_tag in source_path:
             return class_tag
 
-    print "Could not determine class of %s" % desc.source_path
+    print "Could not determine class of %s" % source_path
     return None
 
 def get_mouse(desc):
@@ -88,11 +88,12 @@ def main():
     structure_finder = allen_atlas.StructureFinder(structure_data_path)
 
     # Get cell counts
-    for image_descriptor in db_man.get_image_iter():
-        print "Processing %s" % image_descriptor.source_path
-        image_class = get_class(image_descriptor)
+    # Only the cell records are read, not the cells' image crops
+    for cell_table in db_man.get_cell_table_iter():
+        print "Processing %s" % cell_table['source_path']
+        image_class = get_class(cell_table['source_path'])
         print "Detected class: ", image_class
-        update_count(counts[image_class], analysis.get_cell_counts_per_region(image_descriptor))
+        update_count(counts[image_class], analysis.get_cell_counts_per_region_from_cell_table(cell_table))
 
     pprint(counts)
 
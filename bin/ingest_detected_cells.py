@@ -0,0 +1,55 @@
+from experiment_handling import io
+from argparse import ArgumentParser
+from glob import glob
+from itertools import chain, imap
+from os import path
+
+
+def configure_parser():
+    parser = ArgumentParser(description='Adds the pickled image descriptors written by pickle_cells_from_metadata.py '
+                                        '(_detectedCells.p files) to an image database. Files that have already been '
+                                        'ingested are skipped, unless their size or modification time has changed')
+    parser.add_argument('db_path', help='Path to the image database to add the images to')
+    parser.add_argument('p_files', nargs='+', help='Paths or glob expressions of the pickle files to ingest')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='The number of processes used to load pickle files. Defaults to the number of cpus')
+    parser.add_argument('-b', '--batch_size', type=int, default=100,
+                        help='The maximum number of images committed in each transaction. Default = 100')
+    parser.add_argument('--max_batch_bytes', type=int, default=2**28,
+                        help='The maximum number of encoded bytes committed in each transaction. Default = 2**28')
+    parser.add_argument('-c', '--codec', default='zlib', choices=sorted(io.record_codecs),
+                        help='The codec to compress records with. Default = zlib')
+    parser.add_argument('-f', '--force', default=False, action='store_true',
+                        help='Ingest every file, even if it has already been ingested')
+
+    return parser
+
+
+def main():
+    parser = configure_parser()
+    args = parser.parse_args()
+
+    db_manager = io.ImageDbManager(path.expanduser(args.db_path), readonly=False, codec=args.codec)
+
+    p_file_paths = sorted(set(chain(*imap(glob, imap(path.expanduser, args.p_files)))))
+    if args.force:
+        files_to_ingest = p_file_paths
+    else:
+        files_to_ingest = db_manager.get_files_to_ingest(p_file_paths)
+    print "Ingesting %d files, skipping %d already ingested files" % (
+        len(files_to_ingest), len(p_file_paths) - len(files_to_ingest))
+
+    num_failed = 0
+    ingested = db_manager.ingest_image_files(files_to_ingest, processes=args.processes,
+                                             max_records=args.batch_size, max_bytes=args.max_batch_bytes)
+    for i, (file_path, error) in enumerate(ingested):
+        if error is None:
+            print "Ingested file %d/%d: %s" % (i + 1, len(files_to_ingest), file_path)
+        else:
+            num_failed += 1
+            print "Failed to ingest %s:\n%s" % (file_path, error)
+
+    print "Ingested %d files, %d failed" % (len(files_to_ingest) - num_failed, num_failed)
+
+if __name__ == '__main__':
+    main()
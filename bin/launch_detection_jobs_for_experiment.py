@@ -69,6 +69,12 @@ def main():
     for entry in metadata_handler.metadata:
         if not entry['exclude']:
             scheduler.add_process(create_process(args, entry))
+
+            # Record where the detection output will be written, without rewriting all of metadata.json
+            metadata_handler.patch_entry(entry['vsiPath'], {
+                'detectionLog': entry['detectionLog'],
+                'detectedCellsPath': entry['detectedCellsPath']
+            })
         else:
             print "Entry %s is marked for exclusion" % entry['vsiPath']
 
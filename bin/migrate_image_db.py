@@ -0,0 +1,35 @@
+from experiment_handling import io
+from argparse import ArgumentParser
+from os import path
+
+
+def configure_parser():
+    parser = ArgumentParser(description='Rewrites the records in an image database in place, '
+                                        'in the current serialization format and with the given codec')
+    parser.add_argument('db_path', help='Path to the image database to migrate')
+    parser.add_argument('-c', '--codec', default='zlib', choices=sorted(io.record_codecs),
+                        help='The codec to compress records with. Default = zlib')
+    parser.add_argument('-b', '--batch_size', type=int, default=100,
+                        help='The number of records rewritten in each transaction. Default = 100')
+    parser.add_argument('--remove_unreferenced_maps', action='store_true',
+                        help='Delete maps that are no longer referenced by any image after migrating')
+
+    return parser
+
+
+def main():
+    parser = configure_parser()
+    args = parser.parse_args()
+
+    db_manager = io.ImageDbManager(path.expanduser(args.db_path), readonly=False, codec=args.codec)
+
+    print "Migrating %s" % args.db_path
+    num_rewritten = db_manager.migrate_records(batch_size=args.batch_size)
+    print "Rewrote %d records" % num_rewritten
+    print "Wrote %d image summaries" % db_manager.rebuild_summaries()
+
+    if args.remove_unreferenced_maps:
+        print "Removed %d unreferenced maps" % db_manager.remove_unreferenced_maps()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+from experiment_handling import io
+from argparse import ArgumentParser
+from os import path, getcwd
+
+
+def configure_parser():
+    parser = ArgumentParser(description='Packs the registered atlas label maps and hemisphere maps of every image in '
+                                        'an experiment into a single file, which ImageDescriptor.from_metadata and '
+                                        'the stats scripts read instead of the individual mhd files')
+    parser.add_argument('-e', '--experiment_path', default=getcwd(),
+                        help='The root directory of the experiment.  Defaults to the current directory.')
+    parser.add_argument('-o', '--output_path', default=None,
+                        help='Path to write the packed label maps to.  '
+                             'Default = experiment_path/.registrationData/label_maps.pack')
+
+    return parser
+
+
+def main():
+    parser = configure_parser()
+    args = parser.parse_args()
+
+    experiment_path = path.expanduser(args.experiment_path)
+    if args.output_path is None:
+        output_path = io.LabelMapStore.generate_store_path(experiment_path)
+    else:
+        output_path = path.expanduser(args.output_path)
+
+    metadata = io.MetadataManager(experiment_path).load_metadata()
+
+    print "Packing the label maps of %d images into %s" % (len(metadata), output_path)
+    packed, skipped = io.pack_label_maps(output_path, metadata, experiment_path)
+
+    for vsi_path in skipped:
+        print "Could not load registration results for %s.  Registration probably failed" % vsi_path
+    print "Packed %d images, skipped %d" % (len(packed), len(skipped))
+
+if __name__ == '__main__':
+    main()
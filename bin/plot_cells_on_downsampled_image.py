@@ -52,7 +52,7 @@ def main():
 
         # Load downsampled image
         ds_im_path = path.join(experiment_path, entry['downsampledImagePath'])
-        ds_im = io.load_mhd(ds_im_path)[0]
+        ds_im = io.load_mhd_cached(ds_im_path)[0]
 
         figure()
         imshow(ds_im, cmap=cm.Greys)
@@ -3,15 +3,6 @@ from os import path
 from experiment_handling import io
 from itertools import islice, izip
 
-def get_entry_from_name(name, metadata):
-    for entry in metadata:
-        if name in entry['vsiPath']:
-            return entry
-
-    print "No Entry Found for image %s" % name
-    return {}
-
-
 def main():
     from sys import argv
     if len(argv) < 4:
@@ -27,7 +18,7 @@ def main():
     meta_man = io.MetadataManager(exp_path)
 
     unique_ims = set(df['image'])
-    entry_map = {im_name: get_entry_from_name(im_name, meta_man.metadata) for im_name in unique_ims}
+    entry_map = {im_name: meta_man.get_entry_from_name(im_name) or {} for im_name in unique_ims}
     zipped = izip(df['image'], df['region'], df['hemisphere'])
 
     dqs = [[region, hemisphere] in entry_map[im_name].get('regionIdsToExclude', list()) for im_name, region, hemisphere in zipped]
@@ -1,15 +1,253 @@
+import csv
 import json
+import numpy
+import os
+import shutil
+import hashlib
+import tempfile
 from os import path
+from warnings import warn
 from itertools import imap, chain
+from experiment_handling import caching, files
 
 
-class StructureFinder:
+class StructureFinder(object):
     """
     I find the structure in the allen brain atlas corresponding to the given trait
     """
 
-    def __init__(self, structure_data_path):
-        self.structureData = self._load_structure_data(structure_data_path)
+    # Structures can be looked up by these attributes in constant time.  Other attributes require a full search
+    indexed_attributes = ('id', 'acronym', 'name')
+
+    # Roll up tables are indexed directly by id when the largest id is at most this big, otherwise ids are
+    #  mapped to the table by binary search
+    max_dense_table_id = 2**24
+
+    # Increment when the layout of the compiled structure data changes, so that old caches are rebuilt
+    compiled_format_version = 1
+    compiled_array_names = ('ids', 'parents', 'intervals', 'depths', 'acronyms', 'names')
+
+    # Columns produced by get_hierarchy_columns, in the order they are written
+    hierarchy_column_names = ('id', 'acronym', 'name', 'parent_id', 'depth', 'enter', 'exit', 'subtree_size',
+                              'path', 'parent_acronyms', 'child_acronyms')
+
+    def __init__(self, structure_data_path, use_cache=True, query_cache_size=1024):
+        """
+        :param structure_data_path: Path to the allen brain atlas structure data json file
+        :param use_cache: If True, the flattened structure data is compiled to a cache directory next to the json
+            file (structure_data_path + '.cache') the first time it is loaded, and memory mapped from there afterwards.
+            The json file itself is then only parsed if whole structures are requested
+        :param query_cache_size: The number of results of batched queries (e.g. get_ids_by_acronyms) to memoize
+        """
+        self.structure_data_path = structure_data_path
+        self._structure_data = None
+        self._structure_list = None
+
+        if use_cache:
+            compiled_data = self._load_compiled_structure_data(structure_data_path)
+        else:
+            compiled_data = self._compile_structure_data(self.structureData)
+
+        self._index_compiled_structure_data(compiled_data)
+        self._query_cache = caching.LRUCache(max_items=query_cache_size)
+
+    @property
+    def structureData(self):
+        """
+        The root of the allen brain atlas structure data, loaded from the json file on first access
+        """
+        if self._structure_data is None:
+            self._structure_data = self._load_structure_data(self.structure_data_path)
+        return self._structure_data
+
+    @property
+    def _structures(self):
+        """
+        All structures in self.structureData in pre order.  The position of a structure in this list is it's
+        position in the compiled structure data
+        """
+        if self._structure_list is None:
+            self._structure_list = [structure for structure, _ in self._generate_structures_in_pre_order(self.structureData)]
+        return self._structure_list
+
+    @staticmethod
+    def _generate_structures_in_pre_order(root):
+        """
+        A generator function that yields tuples (structure, parent_position) for the given structure and all of
+        it's descendants, in pre order, without recursion
+        :param root: The root structure of the allen brain atlas structure data
+        """
+        stack = [(root, -1)]
+        position = 0
+        while stack:
+            structure, parent_position = stack.pop()
+            yield structure, parent_position
+            # Children are pushed in reverse so that they are popped in their original order
+            stack.extend((child, position) for child in reversed(structure['children']))
+            position += 1
+
+    def _compile_structure_data(self, root):
+        """
+        Flattens the structure tree into flat arrays in pre order: ids, parent positions, subtree intervals,
+        depths, acronyms and names
+
+        In pre order, the structure at position p and all of it's descendants occupy the positions in the
+        interval [intervals[p, 0], intervals[p, 1]), where intervals[p, 0] == p
+        :param root: The root structure of the allen brain atlas structure data
+        :return: A dict of numpy arrays, keyed by the names in self.compiled_array_names
+        """
+        structures, parent_positions = zip(*self._generate_structures_in_pre_order(root))
+        self._structure_list = list(structures)
+
+        # Subtree sizes are accumulated from the leaves up, children always follow their parents in pre order
+        subtree_sizes = [1] * len(structures)
+        for position in xrange(len(structures) - 1, 0, -1):
+            subtree_sizes[parent_positions[position]] += subtree_sizes[position]
+
+        # The root is at depth 0
+        depths = [0] * len(structures)
+        for position in xrange(1, len(structures)):
+            depths[position] = depths[parent_positions[position]] + 1
+
+        return {
+            'ids': numpy.asarray([structure['id'] for structure in structures], dtype=numpy.int64),
+            'parents': numpy.asarray(parent_positions, dtype=numpy.int32),
+            'intervals': numpy.column_stack((numpy.arange(len(structures)),
+                                             numpy.arange(len(structures)) + subtree_sizes)).astype(numpy.int64),
+            'depths': numpy.asarray(depths, dtype=numpy.int32),
+            'acronyms': numpy.asarray([structure['acronym'] for structure in structures], dtype=numpy.unicode_),
+            'names': numpy.asarray([structure['name'] for structure in structures], dtype=numpy.unicode_)
+        }
+
+    def _index_compiled_structure_data(self, compiled_data):
+        """
+        Builds hash indexes, parent pointers and subtree boundaries from the compiled structure data, so that
+        structures, their parents and their descendants can be found without walking the tree.
+
+        In pre order, the descendants of the structure at position p occupy positions p + 1 up to (but not
+        including) self._subtree_ends[p]
+        :param compiled_data: A dict of arrays as returned by _compile_structure_data
+        """
+        self._ids = compiled_data['ids'].tolist()
+
+        # Subtrees are contiguous in pre order, so slices of this array are the ids of a structure and it's progeny.
+        #  Slices are views, which must not be able to modify the index
+        self._id_array = numpy.asarray(compiled_data['ids'])
+        self._id_array.setflags(write=False)
+        self._acronyms = compiled_data['acronyms'].tolist()
+        self._names = compiled_data['names'].tolist()
+        self._parent_positions = compiled_data['parents'].tolist()
+        self._depths = compiled_data['depths'].tolist()
+
+        # Nested set encoding: each structure is described by the interval [enter, exit) of pre order positions
+        #  covering its subtree, so ancestry tests on whole arrays of ids reduce to two comparisons
+        self._intervals = compiled_data['intervals']
+        self._subtree_ends = self._intervals[:, 1].tolist()
+
+        # Ids are mapped to positions with a binary search, allen ids are too sparse for a dense table
+        self._id_sort_order = numpy.argsort(compiled_data['ids'], kind='mergesort')
+        self._sorted_ids = compiled_data['ids'][self._id_sort_order]
+
+        # Roll up tables are built on demand, keyed by (depth, acronyms)
+        self._rollup_tables = dict()
+
+        # The first structure in pre order wins, which matches the result of a depth first search
+        self._positions = dict()
+        for attribute, values in (('id', self._ids), ('acronym', self._acronyms), ('name', self._names)):
+            index = self._positions[attribute] = dict()
+            for position, value in enumerate(values):
+                index.setdefault(value, position)
+
+    def _load_compiled_structure_data(self, structure_data_path):
+        """
+        Loads the compiled structure data for the given json file from it's cache directory, compiling it first
+        if the cache doesn't exist or is out of date.
+
+        The cache is up to date if the modification time and size of the json file match those recorded when it
+        was compiled.  If they don't, the sha256 of the json file is compared to the one recorded instead
+        :param structure_data_path: Path to the allen brain atlas structure data json file
+        :return: A dict of (memory mapped) numpy arrays, keyed by the names in self.compiled_array_names
+        """
+        cache_path = structure_data_path + '.cache'
+        source_stat = os.stat(structure_data_path)
+        source_hash = None
+
+        try:
+            source_info = json.load(open(path.join(cache_path, 'source.json')))
+            if source_info['version'] != self.compiled_format_version:
+                raise ValueError('Compiled with format version %r' % source_info['version'])
+
+            if (source_info['mtime'], source_info['size']) != (source_stat.st_mtime, source_stat.st_size):
+                source_hash = self._hash_file(structure_data_path)
+                if source_info['sha256'] != source_hash:
+                    raise ValueError('Structure data has changed')
+                # The json file was touched but not changed, record its new modification time
+                source_info['mtime'] = source_stat.st_mtime
+                with files.open_atomically(path.join(cache_path, 'source.json')) as f:
+                    json.dump(source_info, f)
+
+            return {name: numpy.load(path.join(cache_path, name + '.npy'), mmap_mode='r')
+                    for name in self.compiled_array_names}
+        except (IOError, OSError, ValueError, KeyError):
+            # The cache doesn't exist, is out of date or is unreadable
+            pass
+
+        compiled_data = self._compile_structure_data(self.structureData)
+        if source_hash is None:
+            source_hash = self._hash_file(structure_data_path)
+        source_info = {
+            'version': self.compiled_format_version,
+            'mtime': source_stat.st_mtime,
+            'size': source_stat.st_size,
+            'sha256': source_hash
+        }
+
+        try:
+            self._write_compiled_structure_data(cache_path, compiled_data, source_info)
+        except (IOError, OSError) as e:
+            warn('Could not write structure data cache to %s: %s' % (cache_path, e))
+
+        return compiled_data
+
+    def _write_compiled_structure_data(self, cache_path, compiled_data, source_info):
+        """
+        Writes compiled structure data to cache_path.  The cache is written to a temporary directory which is then
+        renamed, so that many processes can start at once without reading a partially written cache
+        """
+        temp_path = tempfile.mkdtemp(prefix=path.basename(cache_path) + '.', dir=path.dirname(cache_path))
+        try:
+            for name in self.compiled_array_names:
+                numpy.save(path.join(temp_path, name + '.npy'), compiled_data[name])
+            with open(path.join(temp_path, 'source.json'), 'w') as f:
+                json.dump(source_info, f)
+
+            if path.exists(cache_path):
+                shutil.rmtree(cache_path, ignore_errors=True)
+            try:
+                os.rename(temp_path, cache_path)
+            except OSError:
+                # Another process has just written the cache, it's compiled from the same data
+                pass
+        finally:
+            if path.exists(temp_path):
+                shutil.rmtree(temp_path, ignore_errors=True)
+
+    @staticmethod
+    def _hash_file(file_path, block_size=2**20):
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), ''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _get_position(self, attribute, value):
+        """
+        Looks up the pre order position of the structure who's attribute == value in the hash indexes
+        :param attribute: The attribute to be checked, must be one of self.indexed_attributes
+        :param value: The desired value of that attribute
+        :return: The position of the structure, None if that structure can't be found
+        """
+        return self._positions[attribute].get(value)
 
     def get_ids_by_acronym(self, acronym):
         return self._get_ids_by_attribute('acronym', acronym)
@@ -21,13 +259,13 @@ class StructureFinder:
         return self._get_ids_by_attribute('id', id_no)
 
     def get_name_from_id(self, id_no):
-        structure = self.search_structure_data_for_attribute('id', id_no)
-        if structure is None:
+        position = self._get_position('id', id_no)
+        if position is None:
             if id_no != 0:
                 print "Could not find structure with id: %r" % id_no
             return None
         else:
-            return structure['name']
+            return self._names[position]
 
     def _get_ids_by_attribute(self, attribute, value):
         """
@@ -36,11 +274,249 @@ class StructureFinder:
         :param value: Value of the attribute
         :return: List of ids corresponding to the ids of the identified structure and all of it's progeny
         """
-        structure = self.search_structure_data_for_attribute(attribute, value)
-        if structure is not None:
+        if attribute not in self.indexed_attributes:
+            structure = self.search_structure_data_for_attribute(attribute, value)
+            if structure is None:
+                raise StructureNotFoundError(attribute, value)
             return self.get_ids_from_structure(structure)
-        else:
+
+        position = self._get_position(attribute, value)
+        if position is None:
+            raise StructureNotFoundError(attribute, value)
+        return self._ids[position:self._subtree_ends[position]]
+
+    def get_ids_by_acronyms(self, acronyms):
+        return self._get_ids_by_attribute_values('acronym', acronyms)
+
+    def get_ids_by_structure_names(self, names):
+        return self._get_ids_by_attribute_values('name', names)
+
+    def get_ids_by_ids(self, id_nos):
+        return self._get_ids_by_attribute_values('id', id_nos)
+
+    def _get_ids_by_attribute_values(self, attribute, values):
+        """
+        'Template' function for obtaining the ids of many structures, identified by an attribute, at once.
+        Results are memoized, so repeated queries for the same structures are free
+        :param attribute: Attribute to identify structures by, must be one of self.indexed_attributes
+        :param values: An iterable of values of the attribute
+        :return: A dict mapping each value to a read only numpy array of the ids of the identified structure and all of
+            it's progeny, in pre order
+        """
+        return {value: self._query_cache.get_or_compute(
+                    (attribute, value), lambda: self._get_id_array_by_attribute(attribute, value))
+                for value in values}
+
+    def _get_id_array_by_attribute(self, attribute, value):
+        """
+        Returns a read only view of the ids of the structure who's attribute == value and all of it's progeny
+        """
+        position = self._get_position(attribute, value)
+        if position is None:
+            raise StructureNotFoundError(attribute, value)
+        return self._id_array[position:self._subtree_ends[position]]
+
+    def get_interval_by_acronym(self, acronym):
+        return self._get_interval_by_attribute('acronym', acronym)
+
+    def get_interval_by_structure_name(self, name):
+        return self._get_interval_by_attribute('name', name)
+
+    def get_interval_by_id(self, id_no):
+        return self._get_interval_by_attribute('id', id_no)
+
+    def _get_interval_by_attribute(self, attribute, value):
+        """
+        'Template' function for obtaining the pre order interval of a structure identified by an attribute
+        :param attribute: Attribute to identify structure by
+        :param value: Value of the attribute
+        :return: Tuple (enter, exit).  The structure and all of it's progeny have pre order positions p where enter <= p < exit
+        """
+        position = self._get_position(attribute, value)
+        if position is None:
             raise StructureNotFoundError(attribute, value)
+        return tuple(self._intervals[position])
+
+    def get_positions_from_ids(self, id_array):
+        """
+        Maps an array of structure ids to the pre order positions of those structures
+        :param id_array: An array (or anything numpy.asarray accepts) of structure ids, of any shape
+        :return: An int64 array with the same shape as id_array.  Ids that aren't in the atlas (e.g. 0) map to -1
+        """
+        id_array = numpy.asarray(id_array)
+        indices = numpy.searchsorted(self._sorted_ids, id_array)
+        # Ids larger than every id in the atlas produce indices past the end
+        indices = numpy.where(indices == len(self._sorted_ids), 0, indices)
+        return numpy.where(self._sorted_ids[indices] == id_array, self._id_sort_order[indices], -1)
+
+    def in_subtree(self, id_array, acronym):
+        return self._in_subtree_by_attribute(id_array, 'acronym', acronym)
+
+    def in_subtree_by_structure_name(self, id_array, name):
+        return self._in_subtree_by_attribute(id_array, 'name', name)
+
+    def _in_subtree_by_attribute(self, id_array, attribute, value):
+        """
+        'Template' function for testing which of an array of ids lie within a structure, in one vectorized pass
+        :param id_array: An array of structure ids, of any shape (e.g. a region map, or the region column of a dataframe)
+        :param attribute: Attribute to identify structure by
+        :param value: Value of the attribute
+        :return: A boolean array with the same shape as id_array.  True where the id is the identified structure or one of it's progeny
+        """
+        enter, exit = self._get_interval_by_attribute(attribute, value)
+        positions = self.get_positions_from_ids(id_array)
+        return (positions >= enter) & (positions < exit)
+
+    def get_rollup_table(self, depth=None, acronyms=None):
+        """
+        Builds a dense lookup table that maps each structure id to the id of the coarser structure it rolls up to.
+        A region map, or a column of cell regions, is collapsed with table[id_array] (see rollup_ids)
+
+        Exactly one of depth or acronyms must be given:
+        :param depth: Structures map to their ancestor at this depth in the hierarchy (the root is at depth 0).
+            Structures that are already at or above this depth map to themselves
+        :param acronyms: A collection of structure acronyms.  Structures map to the closest of these structures
+            that they lie within (including themselves), or to 0 if they don't lie within any of them
+        :return: An array of length max_id + 1, indexed by structure id.  Ids that aren't in the atlas map to 0
+
+        Raises a ValueError if the largest id in the atlas is greater than max_dense_table_id, since the table would be
+         too large to allocate.  rollup_ids works with any ids
+        """
+        if self._sorted_ids[-1] > self.max_dense_table_id:
+            raise ValueError('Structure ids go up to %d, dense roll up tables are only built for ids up to %d'
+                             % (self._sorted_ids[-1], self.max_dense_table_id))
+
+        rolled_up_ids = self._get_rolled_up_ids(depth, acronyms)
+        table = numpy.zeros(self._sorted_ids[-1] + 1, dtype=rolled_up_ids.dtype)
+        table[self._ids] = rolled_up_ids
+        return table
+
+    def rollup_ids(self, id_array, depth=None, acronyms=None):
+        """
+        Maps every id in id_array to the id of the coarser structure it rolls up to.  See get_rollup_table
+        :param id_array: An array of structure ids of any shape, e.g. a region map.  Float ids (e.g. from a region
+            column with NaNs) are accepted, ids that aren't integral or aren't in the atlas map to 0
+        :return: An array of structure ids with the same shape as id_array
+        """
+        id_array = numpy.asarray(id_array)
+        # Non integer ids can't index the table, they're looked up by binary search like in_subtree does
+        if self._sorted_ids[-1] > self.max_dense_table_id or not numpy.issubdtype(id_array.dtype, numpy.integer):
+            positions = self.get_positions_from_ids(id_array)
+            rolled_up_ids = self._get_rolled_up_ids(depth, acronyms)
+            return numpy.where(positions >= 0, rolled_up_ids[positions], 0)
+
+        key = ('table', depth, None if acronyms is None else frozenset(acronyms))
+        if key not in self._rollup_tables:
+            self._rollup_tables[key] = self.get_rollup_table(depth, acronyms)
+        table = self._rollup_tables[key]
+
+        if id_array.size == 0 or (id_array.min() >= 0 and id_array.max() < len(table)):
+            return table[id_array]
+        in_table = (id_array >= 0) & (id_array < len(table))
+        return numpy.where(in_table, table[numpy.where(in_table, id_array, 0)], 0)
+
+    def _get_rolled_up_ids(self, depth=None, acronyms=None):
+        """
+        Computes the ids that each structure rolls up to, in pre order.  See get_rollup_table
+        :return: An array with one id per structure, in pre order
+        """
+        if (depth is None) == (acronyms is None):
+            raise ValueError('Exactly one of depth or acronyms must be specified')
+
+        key = ('positions', depth, None if acronyms is None else frozenset(acronyms))
+        if key in self._rollup_tables:
+            return self._rollup_tables[key]
+
+        if depth is not None:
+            is_target = [structure_depth <= depth for structure_depth in self._depths]
+        else:
+            is_target = [False] * len(self._ids)
+            for acronym in acronyms:
+                position = self._get_position('acronym', acronym)
+                if position is None:
+                    raise StructureNotFoundError('acronym', acronym)
+                is_target[position] = True
+
+        # Parents precede their children in pre order, so every parent is resolved before it's children
+        rolled_up_positions = [-1] * len(self._ids)
+        for position, parent_position in enumerate(self._parent_positions):
+            if is_target[position]:
+                rolled_up_positions[position] = position
+            elif parent_position != -1:
+                rolled_up_positions[position] = rolled_up_positions[parent_position]
+
+        rolled_up_ids = numpy.asarray(
+            [self._ids[position] if position != -1 else 0 for position in rolled_up_positions],
+            dtype=numpy.min_scalar_type(self._sorted_ids[-1])
+        )
+        self._rollup_tables[key] = rolled_up_ids
+        return rolled_up_ids
+
+    def get_hierarchy_columns(self, delimiter='\t', path_delimiter='/'):
+        """
+        Describes where every structure lies in the hierarchy, in a single pass over the structures in pre order
+        :param delimiter: Separates the acronyms in the parent_acronyms and child_acronyms columns
+        :param path_delimiter: Separates the acronyms in the path column
+        :return: A dict of equal length columns, keyed by the names in self.hierarchy_column_names,
+            with one row per structure, in pre order:
+            'parent_id' is 0 for the root,
+            'enter' and 'exit' are the structure's pre order interval (see _get_interval_by_attribute),
+            'subtree_size' counts the structure and all of it's descendants,
+            'path' lists acronyms from the root down to the structure,
+            'parent_acronyms' lists the structure and all of it's parents, in the order returned by get_parents_by_attribute,
+            'child_acronyms' lists the structure's direct children
+        """
+        parent_chains = list()
+        paths = list()
+        child_acronyms = [list() for _ in self._ids]
+
+        # Parents precede their children in pre order, so every parent's chain is complete before it's children's
+        for position, parent_position in enumerate(self._parent_positions):
+            acronym = self._acronyms[position]
+            if parent_position == -1:
+                parent_chains.append(acronym)
+                paths.append(acronym)
+            else:
+                parent_chains.append(acronym + delimiter + parent_chains[parent_position])
+                paths.append(paths[parent_position] + path_delimiter + acronym)
+                child_acronyms[parent_position].append(acronym)
+
+        return {
+            'id': list(self._ids),
+            'acronym': list(self._acronyms),
+            'name': list(self._names),
+            'parent_id': [self._ids[parent] if parent != -1 else 0 for parent in self._parent_positions],
+            'depth': list(self._depths),
+            'enter': self._intervals[:, 0].tolist(),
+            'exit': self._intervals[:, 1].tolist(),
+            'subtree_size': (self._intervals[:, 1] - self._intervals[:, 0]).tolist(),
+            'path': paths,
+            'parent_acronyms': parent_chains,
+            'child_acronyms': map(delimiter.join, child_acronyms)
+        }
+
+    def write_hierarchy_csv(self, output_path, delimiter='\t', path_delimiter='/'):
+        """
+        Writes the columns from get_hierarchy_columns to a utf-8 encoded csv file, with a header row
+        """
+        columns = self.get_hierarchy_columns(delimiter, path_delimiter)
+        with open(output_path, 'wb') as output_file:
+            writer = csv.writer(output_file)
+            writer.writerow(self.hierarchy_column_names)
+            for row in zip(*[columns[name] for name in self.hierarchy_column_names]):
+                writer.writerow([value.encode('utf-8') if isinstance(value, unicode) else value for value in row])
+
+    def write_hierarchy_columns(self, output_path, delimiter='\t', path_delimiter='/'):
+        """
+        Writes the columns from get_hierarchy_columns to an uncompressed .npz file, one numpy array per column.
+        Load it with numpy.load(output_path)
+        """
+        columns = self.get_hierarchy_columns(delimiter, path_delimiter)
+        arrays = {name: numpy.asarray(values) for name, values in columns.iteritems()}
+        for name in ('acronym', 'name', 'path', 'parent_acronyms', 'child_acronyms'):
+            arrays[name] = numpy.asarray(columns[name], dtype=numpy.unicode_)
+        with open(output_path, 'wb') as output_file:
+            numpy.savez(output_file, **arrays)
 
     def get_parents_by_attribute(self, attribute, value):
         """
@@ -49,7 +525,18 @@ class StructureFinder:
         :param value: Value of the attribute
         :return: List of structures corresponding to the parents of the identified structure, in ascending order (i.e. the direct parent is first and the root node is last)
         """
-        return self._get_parent_list_by_attribute_from_structure(self.structureData, attribute, value)
+        if attribute not in self.indexed_attributes:
+            return self._get_parent_list_by_attribute_from_structure(self.structureData, attribute, value)
+
+        position = self._get_position(attribute, value)
+        if position is None:
+            return None
+
+        parents = list()
+        while position != -1:
+            parents.append(self._structures[position])
+            position = self._parent_positions[position]
+        return parents
 
     def _get_parent_list_by_attribute_from_structure(self, structure, attribute, value):
         """
@@ -79,7 +566,20 @@ class StructureFinder:
         """
         Returns all structures in self as a list, in pre order
         """
-        return list(self._generate_child_structures(self.structureData))
+        return list(self._structures)
+
+    def get_all_ids(self):
+        """
+        Returns the ids of all structures in self as a list, in pre order
+        """
+        return list(self._ids)
+
+    def get_all_intervals(self):
+        """
+        Returns the pre order intervals of all structures in self as an array with shape (num_structures, 2), in pre order.
+        Row p holds (enter, exit) for the structure at position p, see _get_interval_by_attribute
+        """
+        return self._intervals
 
     def get_all_structures_with_attribute(self, attribute, value):
         """
@@ -88,8 +588,8 @@ class StructureFinder:
         :param value: The desired value of that attribute
         :return: A list of structures contained in structureData who's attribute == value
         """
-        return [struct for struct in self._generate_structure_ids(self.structureData) if struct[attribute] == value]
-        
+        return [struct for struct in self._structures if struct[attribute] == value]
+
     def search_structure_data_for_attribute(self, attribute, value):
         """
         Searches the structure data stored in self.structureData for a structure who's attribute == value
@@ -97,7 +597,13 @@ class StructureFinder:
         :param value: The desired value of that attribute
         :return: The structure contained in structureData who's attribute == value
         """
-        return self._check_structure_for_attribute(self.structureData, attribute, value)
+        if attribute not in self.indexed_attributes:
+            return self._check_structure_for_attribute(self.structureData, attribute, value)
+
+        position = self._get_position(attribute, value)
+        if position is None:
+            return None
+        return self._structures[position]
 
     def _check_structure_for_attribute(self, structure, attribute, value):
         """
@@ -131,7 +637,11 @@ class StructureFinder:
         :param structure: A structure from the allen brain atlas structure data
         :return: A list of ids corresponding to the given structure and all of its descendants
         """
-        return [id_no for id_no in self._generate_structure_ids(structure)]
+        position = self._get_position('id', structure['id'])
+        if position is None:
+            # Structures that aren't part of self.structureData have to be walked
+            return [id_no for id_no in self._generate_structure_ids(structure)]
+        return self._ids[position:self._subtree_ends[position]]
 
     def _generate_structure_ids(self, structure):
         """
@@ -139,18 +649,16 @@ class StructureFinder:
             and all of its descendants
         :param structure: A structure from the allen brain atlas structure data
         """
-        yield structure['id']
-        for id_no in chain(*imap(self._generate_structure_ids, structure['children'])):
-            yield id_no
+        for descendant, _ in self._generate_structures_in_pre_order(structure):
+            yield descendant['id']
 
     def _generate_child_structures(self, structure):
         """
         A generator function that yields the given structure and all of it's descendents
         :param structure: A structure from the allen brain atlas structure data
         """
-        yield structure
-        for child in chain(*imap(self._generate_child_structures, structure['children'])):
-            yield child
+        for descendant, _ in self._generate_structures_in_pre_order(structure):
+            yield descendant
 
     @staticmethod
     def get_structure_property_generator_function(structure_property):
@@ -2,6 +2,8 @@ import numpy
 from experiment_handling import data, io, allen_atlas, conversion
 from argparse import ArgumentParser
 from os import path
+from collections import Counter
+from itertools import izip
 
 
 def get_cell_counts_per_region(image_descriptor):
@@ -22,6 +24,15 @@ def get_cell_counts_per_region(image_descriptor):
     return cell_counts
 
 
+def get_cell_counts_per_region_from_cell_table(cell_table):
+    """
+    Tallies the number of cells in each region of an image from it's cell table (see ImageDescriptor.get_cell_table).
+    Outputs a dict of the form {(region_id, hemisphere_id): num_cells}, like get_cell_counts_per_region
+    """
+    records = cell_table['cells']
+    return dict(Counter(izip(records['region'], records['hemisphere'])))
+
+
 def get_region_containing_cell(cell, image_descriptor, with_hemisphere=True):
     # Get index in region map
     region_map_scale = 25
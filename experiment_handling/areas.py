@@ -0,0 +1,133 @@
+import numpy
+
+
+def count_label_areas(structure_finder, region_map, hemisphere_map=None):
+    """
+    Counts the pixels labelled with each structure in a region map, separately for each hemisphere, in a single
+     bincount over a combined (hemisphere, structure) key
+    :param structure_finder: An allen_atlas.StructureFinder for the ontology used to label region_map
+    :param region_map: An array of structure ids, of any shape
+    :param hemisphere_map: An array of non negative hemisphere labels with the same shape as region_map, or None
+    :return: An int64 array with shape (num_hemisphere_labels, num_structures).  areas[h, p] is the number of pixels
+        in hemisphere h labelled with the structure at pre order position p.  Only pixels labelled with that exact
+        structure are counted, not those labelled with it's descendants.  Pixels labelled with ids that aren't in
+        the atlas (e.g. 0) are ignored.  Without a hemisphere_map, every pixel is counted in hemisphere 0
+    """
+    num_structures = len(structure_finder.get_all_intervals())
+
+    # Key 0 collects pixels that aren't labelled with a structure, and is dropped below
+    keys = structure_finder.get_positions_from_ids(region_map).ravel() + 1
+
+    num_hemispheres = 1
+    if hemisphere_map is not None:
+        hemispheres = numpy.asarray(hemisphere_map, dtype=numpy.int64).ravel()
+        if hemispheres.size:
+            num_hemispheres = hemispheres.max() + 1
+        keys += hemispheres * (num_structures + 1)
+
+    counts = numpy.bincount(keys, minlength=num_hemispheres * (num_structures + 1))
+    return counts.reshape(num_hemispheres, num_structures + 1)[:, 1:]
+
+
+def count_label_areas_by_depth(structure_finder, volume, depth_axis=0, max_slab_bytes=2**26):
+    """
+    Builds a (depth, structure) histogram of a labelled volume in one streaming pass.
+
+    The volume is walked in slabs along it's slowest varying axis, so each slab of a memory mapped volume is
+     a contiguous run of the file, and no more than max_slab_bytes of the volume is in memory at once
+    :param structure_finder: An allen_atlas.StructureFinder for the ontology used to label volume
+    :param volume: A 3d array of structure ids, typically memory mapped (see io.load_mhd)
+    :param depth_axis: The axis of volume that indexes depth
+    :param max_slab_bytes: The largest slab of the volume to read at once, at least one plane is always read
+    :return: An int64 array with shape (num_depths, num_structures).  areas[d, p] is the number of voxels at depth d
+        labelled with the structure at pre order position p, as in count_label_areas
+    """
+    num_structures = len(structure_finder.get_all_intervals())
+    num_depths = volume.shape[depth_axis]
+    counts = numpy.zeros(num_depths * (num_structures + 1), dtype=numpy.int64)
+
+    # The slowest varying axis has the largest stride
+    slab_axis = int(numpy.argmax(numpy.abs(volume.strides)))
+    plane_bytes = volume.itemsize * volume.size // max(volume.shape[slab_axis], 1)
+    planes_per_slab = max(1, max_slab_bytes // max(plane_bytes, 1))
+
+    depth_shape = [1] * volume.ndim
+    depth_shape[depth_axis] = -1
+
+    for start in xrange(0, volume.shape[slab_axis], planes_per_slab):
+        slab_index = [slice(None)] * volume.ndim
+        slab_index[slab_axis] = slice(start, start + planes_per_slab)
+        slab = numpy.asarray(volume[tuple(slab_index)])
+
+        if slab_axis == depth_axis:
+            depths = numpy.arange(start, start + slab.shape[depth_axis], dtype=numpy.int64)
+        else:
+            depths = numpy.arange(num_depths, dtype=numpy.int64)
+        depths = numpy.broadcast_to(depths.reshape(depth_shape), slab.shape)
+
+        # Key 0 of each depth collects voxels that aren't labelled with a structure, and is dropped below
+        keys = depths * (num_structures + 1) + structure_finder.get_positions_from_ids(slab) + 1
+        counts += numpy.bincount(keys.ravel(), minlength=counts.size)
+
+    return counts.reshape(num_depths, num_structures + 1)[:, 1:]
+
+
+def rollup_areas(structure_finder, label_areas):
+    """
+    Rolls label areas up the ontology, so that each structure's area includes the areas of all of it's descendants.
+
+    A structure's descendants follow it in pre order, so it's total is a difference of two prefix sums over the
+     pre order interval of it's subtree, which sums every subtree from the leaves up in one pass
+    :param structure_finder: The allen_atlas.StructureFinder that label_areas was counted with
+    :param label_areas: An array of areas whose last dimension is indexed by pre order position,
+        e.g. the output of count_label_areas
+    :return: An array with the same shape as label_areas, holding the total area of each structure
+    """
+    label_areas = numpy.asarray(label_areas)
+    intervals = structure_finder.get_all_intervals()
+
+    cumulative_areas = numpy.zeros(label_areas.shape[:-1] + (label_areas.shape[-1] + 1,), dtype=label_areas.dtype)
+    numpy.cumsum(label_areas, axis=-1, out=cumulative_areas[..., 1:])
+    return cumulative_areas[..., intervals[:, 1]] - cumulative_areas[..., intervals[:, 0]]
+
+
+def get_area_table(structure_finder, region_map, hemisphere_map=None, hemispheres=None,
+                   rollup=True, leaves_only=False):
+    """
+    Tabulates the area of each structure in a region map
+    :param structure_finder: An allen_atlas.StructureFinder for the ontology used to label region_map
+    :param region_map: An array of structure ids
+    :param hemisphere_map: An array of hemisphere labels with the same shape as region_map, or None
+    :param hemispheres: The hemisphere labels to include in the table.  Defaults to every label in hemisphere_map
+    :param rollup: If True, each structure's area includes the areas of it's descendants
+    :param leaves_only: If True, only structures without children are included in the table
+    :return: A dict of equal length columns 'region', 'hemisphere' and 'area', with one row per hemisphere and
+        structure, in pre order.  The 'hemisphere' column is omitted if no hemisphere_map is given
+    """
+    areas = count_label_areas(structure_finder, region_map, hemisphere_map)
+    if rollup:
+        areas = rollup_areas(structure_finder, areas)
+
+    if hemispheres is None:
+        hemispheres = range(areas.shape[0])
+
+    # Hemispheres that don't appear in hemisphere_map have no area
+    hemispheres = numpy.asarray(hemispheres, dtype=numpy.int64)
+    padded_areas = numpy.zeros((max(hemispheres.max() + 1, areas.shape[0]), areas.shape[1]), dtype=areas.dtype)
+    padded_areas[:areas.shape[0]] = areas
+    areas = padded_areas[hemispheres]
+
+    ids = numpy.asarray(structure_finder.get_all_ids(), dtype=numpy.int64)
+    if leaves_only:
+        intervals = structure_finder.get_all_intervals()
+        is_leaf = intervals[:, 1] - intervals[:, 0] == 1
+        ids = ids[is_leaf]
+        areas = areas[:, is_leaf]
+
+    table = {
+        'region': numpy.tile(ids, len(hemispheres)),
+        'area': areas.ravel()
+    }
+    if hemisphere_map is not None:
+        table['hemisphere'] = numpy.repeat(hemispheres, len(ids))
+    return table
@@ -0,0 +1,102 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A bounded mapping that discards the least recently used items once it holds more than max_items items,
+     or once the total size of it's items is more than max_bytes.  Either bound can be None to disable it
+
+    Item sizes are measured with get_size(value), which defaults to the nbytes of numpy arrays (and tuples or lists
+     of them).  Items larger than max_bytes are never stored
+
+    Counts cache hits and misses, so that the effectiveness of the cache can be checked
+    """
+
+    def __init__(self, max_items=128, max_bytes=None, get_size=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        self._get_size = get_size if get_size is not None else get_nbytes
+        self._items = OrderedDict()
+        self._sizes = dict()
+
+    def get(self, key, default=None):
+        """
+        Returns the value stored for key, marking it as the most recently used, or default if key isn't cached
+        """
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._items[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Stores value for key, discarding the least recently used items if the cache is full
+        """
+        self._discard(key)
+
+        size = self._get_size(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        self._items[key] = value
+        self._sizes[key] = size
+        self.bytes += size
+        while ((self.max_items is not None and len(self._items) > self.max_items)
+               or (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            self._discard(next(iter(self._items)))
+
+    def _discard(self, key):
+        if key in self._items:
+            del self._items[key]
+            self.bytes -= self._sizes.pop(key)
+
+    def get_or_compute(self, key, compute_function):
+        """
+        Returns the value stored for key.  If key isn't cached, compute_function() is called and it's result is stored
+        """
+        value = self.get(key, _missing)
+        if value is _missing:
+            value = compute_function()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        """
+        Discards all cached items.  The hit and miss counters are not reset
+        """
+        self._items.clear()
+        self._sizes.clear()
+        self.bytes = 0
+
+    def get_stats(self):
+        """
+        Returns a dict with the number of cached items, their total size in bytes, hits and misses
+        """
+        return {'items': len(self._items), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses}
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+
+def get_nbytes(value):
+    """
+    Returns the nbytes of a numpy array, or the total nbytes of the arrays in a tuple or list.  Other values are 0
+    """
+    if isinstance(value, (tuple, list)):
+        return sum(get_nbytes(item) for item in value)
+    return getattr(value, 'nbytes', 0)
+
+
+# Distinguishes cache misses from cached None values
+_missing = object()
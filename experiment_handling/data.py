@@ -1,10 +1,36 @@
 import numpy
 import conversion, io
-from os import path, getcwd
-from fisherman import detection
+from os import getcwd
+try:
+    from fisherman.detection import Cell as _CellBase
+except ImportError:
+    _CellBase = None
+
+
+# The percentiles of each cell's signal channel that are summarized in it's cell record
+cell_record_percentiles = range(0, 105, 5)
+
+# Summary of a single cell.  Centroids and bounding boxes are in physical coordinates, regions and hemispheres are
+#  looked up in the region and hemisphere maps of the image containing the cell (0 if the cell lies outside them)
+cell_record_dtype = numpy.dtype([
+    ('centroid', numpy.float32, (2,)),
+    ('bbox', numpy.float32, (4,)),
+    ('number_of_pixels', numpy.int64),
+    ('mean', numpy.float64),
+    ('percentiles', numpy.float64, (len(cell_record_percentiles),)),
+    ('region', numpy.int64),
+    ('hemisphere', numpy.int64),
+    ('region_size', numpy.int64)
+])
 
 
 class ImageDescriptor(object):
+
+    # Maps stored in an ImageDbManager are referenced by the hash of their contents,
+    #  and loaded by the database's map loader the first time they are accessed (see set_map_loader)
+    _region_map_key = None
+    _hemisphere_map_key = None
+    _map_loader = None
     
     def __init__(self, 
                  source_path, 
@@ -36,13 +62,16 @@ class ImageDescriptor(object):
                       cells=None, 
                       experiment_path=getcwd(),
                       flip=False,
-                      flop=False):
+                      flop=False,
+                      label_map_store=None):
         """
         Instantiate an image from the given metadata dict (from a fishRegistration experiment's metadata.json file)
+
+        The region and hemisphere maps are loaded with io.load_label_maps, from label_map_store (an io.LabelMapStore)
+         if it holds them, so they're read only
         """
 
-        region_map = io.load_mhd(path.join(experiment_path, metadata['registeredAtlasLabelsPath']))[0]
-        hemisphere_map = io.load_mhd(path.join(experiment_path, metadata['registeredHemisphereLabelsPath']))[0]
+        region_map, hemisphere_map = io.load_label_maps(metadata, experiment_path, label_map_store)
 
         if flip:
             region_map = numpy.flipud(region_map)
@@ -85,6 +114,8 @@ class ImageDescriptor(object):
          (padding is required, see region_map_scale and region_map_offset)
          the pixel values of the region map correspond to the ids of allen brain atlas regions
         """
+        if self._region_map is None and self._region_map_key is not None:
+            self._region_map = self._load_map(self._region_map_key)
         return self._region_map
 
     @region_map.setter
@@ -93,6 +124,7 @@ class ImageDescriptor(object):
         Sets the region map for this image
         """
         self._region_map = region_map
+        self._region_map_key = None
 
     @property
     def hemisphere_map(self):
@@ -102,11 +134,64 @@ class ImageDescriptor(object):
         The hemisphere_map is a 2d image that maps onto the vsi image, labelling each hemisphere
         """
         # TODO: Which is right, which is left?
+        if self._hemisphere_map is None and self._hemisphere_map_key is not None:
+            self._hemisphere_map = self._load_map(self._hemisphere_map_key)
         return self._hemisphere_map
 
     @hemisphere_map.setter
     def hemisphere_map(self, hemisphere_map):
         self._hemisphere_map = hemisphere_map
+        self._hemisphere_map_key = None
+
+    def get_map_key(self, map_name):
+        """
+        Returns the key that the region or hemisphere map ('region_map' or 'hemisphere_map') is stored under in
+         an image database, if the map hasn't been loaded from it yet.  Otherwise returns None
+        """
+        if getattr(self, '_' + map_name) is not None:
+            return None
+        return getattr(self, '_%s_key' % map_name)
+
+    def set_map_key(self, map_name, key):
+        """
+        Replaces the region or hemisphere map ('region_map' or 'hemisphere_map') with the key it is stored under in
+         an image database.  The map is loaded with the map loader the next time it is accessed
+        """
+        setattr(self, '_' + map_name, None)
+        setattr(self, '_%s_key' % map_name, key)
+
+    def set_map_loader(self, loader):
+        """
+        Sets the function used to load maps from an image database, loader(key) returns the map stored under key
+        """
+        self._map_loader = loader
+
+    def get_map_loader(self):
+        return self._map_loader
+
+    def _load_map(self, key):
+        if self._map_loader is None:
+            raise RuntimeError('Map %s of %s is stored in an image database, but no map loader has been set'
+                               % (key, self.source_path))
+        return self._map_loader(key)
+
+    def __copy__(self):
+        duplicate = type(self).__new__(type(self))
+        duplicate.__dict__.update(self.__dict__)
+        return duplicate
+
+    def __getstate__(self):
+        """
+        Maps that haven't been loaded from an image database yet are loaded before pickling,
+         so that the pickle doesn't depend on the database
+        """
+        if self._map_loader is not None:
+            # Accessing the maps loads them
+            self.region_map
+            self.hemisphere_map
+        state = self.__dict__.copy()
+        state.pop('_map_loader', None)
+        return state
 
     @property
     def region_map_scale(self):
@@ -188,6 +273,49 @@ class ImageDescriptor(object):
         """
         self._cells += list(cells)
 
+    def get_cell_records(self):
+        """
+        Summarizes the cells in this image, without their image crops and masks
+
+        Returns a numpy structured array with dtype cell_record_dtype, with one record per cell
+        """
+        records = numpy.zeros(len(self.cells), dtype=cell_record_dtype)
+        if not self.cells:
+            return records
+
+        records['centroid'] = [cell.centroid for cell in self.cells]
+        records['bbox'] = [cell.bbox for cell in self.cells]
+        records['number_of_pixels'] = [cell.mask.sum() for cell in self.cells]
+        records['mean'] = [cell.image[..., 0].mean() for cell in self.cells]
+        records['percentiles'] = [numpy.percentile(cell.image[..., 0], cell_record_percentiles) for cell in self.cells]
+
+        # Equivalent to looking up every cell with analysis.get_region_containing_cell, in one pass
+        region_map_index = numpy.round(
+            records['centroid'] / conversion.atlas_scale + self.region_map_offset.astype(numpy.int64)
+        )
+        in_bounds = numpy.all((region_map_index >= 0) & (region_map_index < self.region_map.shape[:2]), axis=1)
+        rows, cols = region_map_index[in_bounds].astype(numpy.int64).T
+        records['region'][in_bounds] = self.region_map[rows, cols]
+        records['hemisphere'][in_bounds] = self.hemisphere_map[rows, cols]
+
+        region_ids, region_sizes = numpy.unique(self.region_map, return_counts=True)
+        records['region_size'] = region_sizes[numpy.searchsorted(region_ids, records['region']).clip(0, len(region_ids) - 1)]
+        records['region_size'][~numpy.in1d(records['region'], region_ids)] = 0
+
+        return records
+
+    def get_cell_table(self):
+        """
+        Returns a dict with the cell records of this image (see get_cell_records) under 'cells', along with
+         the image's 'source_path', 'depth' and 'vsi_resolution'
+        """
+        return {
+            'source_path': self.source_path,
+            'depth': self.depth,
+            'vsi_resolution': self.vsi_resolution,
+            'cells': self.get_cell_records()
+        }
+
     @property
     def vsi_resolution(self):
         """
@@ -203,7 +331,40 @@ class ImageDescriptor(object):
         self._vsi_resolution = tuple(resolution)
 
 
-class PhysicalCell(detection.Cell):
+if _CellBase is None:
+    class _CellBase(object):
+        """
+        A minimal stand in for fisherman.detection.Cell, used when fisherman isn't installed.
+
+        Holds a cell's image crop, mask, centroid and bounding box, so that cells can be read from an image database
+         and summarized without fisherman.  Detection and the other fisherman methods aren't available
+        """
+
+        def __init__(self, image, mask, centroid, bounding_box=None):
+            self.image = image
+            self.mask = mask
+            self.centroid = centroid
+            if bounding_box is None:
+                bounding_box = (0, 0) + tuple(numpy.asarray(mask).shape[:2])
+            self.bbox = bounding_box
+
+        def get_centroid(self):
+            return self._centroid
+
+        def set_centroid(self, centroid):
+            self._centroid = numpy.asarray(centroid, dtype=numpy.float32)
+
+        def get_bbox(self):
+            return self._bbox
+
+        def set_bbox(self, bbox):
+            self._bbox = bbox
+
+        centroid = property(get_centroid, set_centroid)
+        bbox = property(get_bbox, set_bbox)
+
+
+class PhysicalCell(_CellBase):
     """
     A fisherman.detection.Cell whose centroid is in physical coordinates.
 
@@ -211,7 +372,7 @@ class PhysicalCell(detection.Cell):
     """
 
     def __init__(self, image, mask, centroid, pixel_scale, **kwargs):
-        detection.Cell.__init__(self, image, mask, centroid, **kwargs)
+        _CellBase.__init__(self, image, mask, centroid, **kwargs)
         self.pixel_scale = pixel_scale
 
     @classmethod
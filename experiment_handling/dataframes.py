@@ -1,8 +1,10 @@
 import pandas
-import numpy
 import re
+import os
+import hashlib
+import tempfile
 from os import path
-from experiment_handling import io, analysis
+from experiment_handling import io, data, serialization
 
 
 classes = [
@@ -20,13 +22,23 @@ classes = [
 
 
 def get_class(input_path):
+    class_tag = parse_class(input_path)
+    if class_tag is not None:
+        print "Found class %s for file %s" % (class_tag.lower(), path.basename(input_path).lower())
+    else:
+        print "Could not determine class of %s" % input_path
+    return class_tag
+
+
+def parse_class(input_path):
+    """
+    Returns the class (condition) in the basename of input_path, or None if it has none.  Unlike get_class, this
+     doesn't print anything
+    """
+    filename = path.basename(input_path).lower()
     for class_tag in classes:
-        if class_tag.lower() in path.basename(input_path).lower():
-            print "Found class %s for file %s" % (class_tag.lower(), path.basename(input_path).lower())
+        if class_tag.lower() in filename:
             return class_tag
-
-
-    print "Could not determine class of %s" % path
     return None
 
 
@@ -59,28 +71,32 @@ def get_slide(input_path):
 
 
 def get_rows_from_image(image):
-    centroids = [cell.centroid for cell in image.cells]
-    regions, hemispheres = zip(*map(lambda cell: analysis.get_region_containing_cell(cell, image), image.cells))
-    region_sizes = [(image.region_map == region_id).sum() for region_id in regions]
-    means = [cell.image[..., 0].mean() for cell in image.cells]
-    image_sizes = [cell.mask.sum() for cell in image.cells]
+    return get_rows_from_cell_table(image.get_cell_table())
+
+
+def get_rows_from_cell_table(cell_table):
+    """
+    Builds a dataframe with one row per cell from a cell table, as returned by ImageDescriptor.get_cell_table
+    """
+    source_path = cell_table['source_path']
+    records = cell_table['cells']
     percentiles = {
-        '{}th percentile'.format(p): [numpy.percentile(cell.image[..., 0], p) for cell in image.cells]
-        for p in range(0, 105, 5)
+        '{}th percentile'.format(p): records['percentiles'][:, i]
+        for i, p in enumerate(data.cell_record_percentiles)
     }
 
     row_dict = {
-        'image': path.basename(image.source_path),
-        'condition': get_class(image.source_path),
-        'animal': get_animal(image.source_path),
-        'slide': get_slide(image.source_path),
-        'image_depth': image.depth,
-        'centroid': centroids,
-        'region': regions,
-        'hemisphere': hemispheres,
-        'region_size': region_sizes,
-        'mean': means,
-        'number_of_pixels': image_sizes
+        'image': path.basename(source_path),
+        'condition': get_class(source_path),
+        'animal': get_animal(source_path),
+        'slide': get_slide(source_path),
+        'image_depth': cell_table['depth'],
+        'centroid': list(records['centroid']),
+        'region': records['region'],
+        'hemisphere': records['hemisphere'],
+        'region_size': records['region_size'],
+        'mean': records['mean'],
+        'number_of_pixels': records['number_of_pixels']
     }
     row_dict.update(percentiles)
     return pandas.DataFrame(row_dict)
@@ -91,6 +107,96 @@ def get_dataframe_from_image_sequence(im_seq):
     return pandas.concat(rows)
 
 
+def get_dataframe_from_cell_table_sequence(cell_table_seq):
+    rows = map(get_rows_from_cell_table, cell_table_seq)
+    return pandas.concat(rows)
+
+
+class CellTableCache(object):
+    """
+    A directory of cell dataframe partitions, one per image in an ImageDbManager, each holding the rows
+     that get_rows_from_cell_table returns for the image's cell table
+
+    Partitions are named by the content hash of the image's cell table (see ImageDbManager.get_summary),
+     so only images that are new or whose cells have changed are recomputed when the dataframe is regenerated
+    """
+
+    # Partitions are named <sha256>.cellrows.pkl.  Only files named like this are pruned, so that other files in the
+    #  directory (e.g. detection outputs) are never deleted
+    partition_extension = '.cellrows.pkl'
+    partition_pattern = re.compile(r'^[0-9a-f]{64}\.cellrows\.pkl$')
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.hits = 0
+        self.misses = 0
+
+    def get_dataframe(self, db_manager, prune=True):
+        """
+        Returns the cell dataframe of every image in db_manager, computing the partitions of images that
+         aren't cached yet.  Partitions of images that are no longer in the database are deleted if prune is True
+        """
+        partition_names = list()
+        for summary in db_manager.get_summary_iter():
+            content_hash = summary.get('content_hash')
+            if content_hash is None:
+                # Summaries written before content hashes were added
+                content_hash = self._hash_cell_table(db_manager.get_cell_table(summary['source_path']))
+
+            partition_names.append(content_hash + self.partition_extension)
+            if path.exists(path.join(self.cache_dir, partition_names[-1])):
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._write_partition(partition_names[-1], db_manager.get_cell_table(summary['source_path']))
+
+        if prune:
+            self._prune(set(partition_names))
+
+        if not partition_names:
+            return pandas.DataFrame()
+        return pandas.concat([pandas.read_pickle(path.join(self.cache_dir, name)) for name in partition_names])
+
+    @staticmethod
+    def _hash_cell_table(cell_table):
+        return hashlib.sha256(serialization.dumps(cell_table)).hexdigest()
+
+    def _write_partition(self, partition_name, cell_table):
+        """
+        Writes a partition to a temporary file that is renamed into place, so interrupted writes can't leave
+         incomplete partitions
+        """
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        os.close(file_descriptor)
+        try:
+            get_rows_from_cell_table(cell_table).to_pickle(temp_path)
+            os.rename(temp_path, path.join(self.cache_dir, partition_name))
+        except:
+            os.remove(temp_path)
+            raise
+
+    def _prune(self, partition_names):
+        for file_name in os.listdir(self.cache_dir):
+            if self.partition_pattern.match(file_name) and file_name not in partition_names:
+                os.remove(path.join(self.cache_dir, file_name))
+
+    def get_stats(self):
+        """
+        Returns a dict with the number of partitions that were read from the cache ('hits') and computed ('misses')
+        """
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def select_rows_in_structure(df, structure_finder, acronym, column='region'):
+    """
+    Returns the rows of df whose region lies inside the structure with the given acronym (or one of it's progeny)
+    """
+    return df[structure_finder.in_subtree(df[column].values, acronym)]
+
+
 def _concatenate_dicts(d1, d2):
     for key, value in d1.iteritems():
         value += d2[key]
@@ -0,0 +1,18 @@
+import os
+from contextlib import contextmanager
+
+
+@contextmanager
+def open_atomically(file_path, mode='w'):
+    """
+    Opens a temporary file next to file_path for writing, and renames it to file_path when the context exits,
+     so readers never see a partially written file.  The temporary file is removed if an exception is raised
+    """
+    temp_path = '%s.%d.tmp' % (file_path, os.getpid())
+    try:
+        with open(temp_path, mode) as temp_file:
+            yield temp_file
+        os.rename(temp_path, file_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
@@ -1,40 +1,494 @@
+import bz2
+import copy
 import json
 import os
+import sys
+import zlib
+import fcntl
 import numpy
 import lmdb
 import hashlib
+import traceback
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
 from warnings import warn
+from experiment_handling import caching, files
+import serialization
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
 
+# Codecs that records in an ImageDbManager can be compressed with.  Maps codec names to (compress, decompress) pairs
+record_codecs = dict()
+
+# Encoded records start with this magic, followed by the length of the codec's name and the name itself.
+#  Records written before codecs were added are raw pickles, which never start with a null byte
+_record_magic = '\x00EHR'
+
+
+def register_record_codec(name, compress, decompress):
+    """
+    Registers a codec that ImageDbManagers can compress records with
+
+    :param name: The name records encoded with the codec are tagged with, at most 255 characters
+    :param compress: A function that takes a string and returns it compressed
+    :param decompress: A function that reverses compress
+    """
+    if not 0 < len(name) < 256:
+        raise ValueError('Codec names must be between 1 and 255 characters long')
+    record_codecs[name] = (compress, decompress)
+
+
+register_record_codec('none', lambda data: data, lambda data: data)
+register_record_codec('zlib', zlib.compress, zlib.decompress)
+register_record_codec('bz2', bz2.compress, bz2.decompress)
+try:
+    import lz4.frame
+    register_record_codec('lz4', lz4.frame.compress, lz4.frame.decompress)
+except ImportError:
+    pass
+
+
+def encode_record(data, codec='zlib'):
+    """
+    Compresses data with the named codec, and prepends a header naming the codec
+    """
+    compress = record_codecs[codec][0]
+    return _record_magic + chr(len(codec)) + codec + compress(data)
+
+
+def get_record_codec(data):
+    """
+    Returns the name of the codec a record was encoded with, or None for records without a header
+    """
+    if not data.startswith(_record_magic):
+        return None
+    name_start = len(_record_magic) + 1
+    return data[name_start:name_start + ord(data[len(_record_magic)])]
+
+
+def decode_record(data):
+    """
+    Decompresses a record encoded with encode_record.  Records without a header are returned unchanged
+    """
+    codec = get_record_codec(data)
+    if codec is None:
+        return data
+    if codec not in record_codecs:
+        raise ValueError('Record was encoded with an unknown codec: %s' % codec)
+    return record_codecs[codec][1](data[len(_record_magic) + 1 + len(codec):])
+
+
 class ImageDbManager(object):
     """
     Manages an database used to store metadata about images in an experiment, including cells that are found using fisherman.
+
+    Each image is stored under the sha256 of it's source path, in several sub databases:
+        The main database holds the image descriptor, without it's cells
+        'cells' holds the image's cell table (see ImageDescriptor.get_cell_table), a numpy structured array
+            summarizing each cell, which can be read without the cells' image crops and masks
+        'crops' holds the cells themselves
+        'maps' holds region and hemisphere maps under the sha256 of their contents, so identical maps are only stored
+            once.  Descriptors reference their maps by that key, and load them the first time they are accessed
+        'summaries' holds a small json summary of each image (see get_summary), so the images in the database can be
+            listed and filtered without decoding them
+        'ingested' records the size and modification time of the files images were ingested from
+            (see ingest_image_files), under the files' paths
+
+    Images added before cells were stored separately only exist in the main database, with their cells and maps
+
+    Records are serialized with serialization.dumps, then compressed with the manager's codec
+     (see register_record_codec) and tagged with the codec's name, so they can be read regardless of the codec the
+     reading manager was opened with.  Uncompressed and pickled records written before codecs and the serialization
+     format were added are still read, and can be rewritten with migrate_records
     """
-    
-    def __init__(self, db_path, readonly=True, map_size=10**12, **kwargs):
+
+    # Names of the sub databases, these are stored as keys in the main database
+    cells_db_name = 'cells'
+    crops_db_name = 'crops'
+    maps_db_name = 'maps'
+    summaries_db_name = 'summaries'
+    ingested_db_name = 'ingested'
+
+    map_names = ('region_map', 'hemisphere_map')
+
+    def __init__(self, db_path, readonly=True, map_size=10**12, codec='zlib', **kwargs):
+        if codec not in record_codecs:
+            raise ValueError('Unknown record codec: %s' % codec)
+        self.codec = codec
+
         # Open the database
+        kwargs.setdefault('max_dbs', 8)
         self._db = lmdb.open(db_path, readonly=readonly, map_size=map_size, **kwargs)
+        self._sub_db_names = set()
+        self._sub_dbs = dict()
+        self._cells_db = self._open_sub_db(self.cells_db_name, readonly)
+        self._crops_db = self._open_sub_db(self.crops_db_name, readonly)
+        self._maps_db = self._open_sub_db(self.maps_db_name, readonly)
+        self._summaries_db = self._open_sub_db(self.summaries_db_name, readonly)
+        self._ingested_db = self._open_sub_db(self.ingested_db_name, readonly)
+
+    def _open_sub_db(self, name, readonly):
+        """
+        Opens the named sub database.  Returns None if the database is readonly and the sub database doesn't exist
+        """
+        self._sub_db_names.add(name)
+        try:
+            self._sub_dbs[name] = self._db.open_db(name, create=not readonly)
+        except lmdb.NotFoundError:
+            self._sub_dbs[name] = None
+        return self._sub_dbs[name]
+
+    @staticmethod
+    def _get_key(source_path):
+        return hashlib.sha256(source_path).hexdigest()
 
     def add_image(self, image):
         """
         Add an image to the database, this will overwrite any existing image with the same source path
         """
-        key = hashlib.sha256(image.source_path).hexdigest()
-        data = pickle.dumps(image)
         with self._db.begin(write=True) as txn:
-            txn.put(key, data)
+            self._write_puts(txn, self.encode_image(image))
 
     def add_image_sequence(self, image_seq):
         """
         Adds a sequence of images to the database in a single transaction
         """
-        keys, data = zip(*[(hashlib.sha256(img.source_path).hexdigest(), pickle.dumps(img)) for img in image_seq])
         with self._db.begin(write=True) as txn:
-            map(txn.put, keys, data)
+            for image in image_seq:
+                self._write_puts(txn, self.encode_image(image))
+
+    def writer(self, max_records=100, max_bytes=2**28):
+        """
+        Returns an ImageDbWriter, that buffers images added to this database and writes them in batches
+
+        The buffered images are committed whenever max_records images or max_bytes of encoded data have been
+         buffered, and when the writer is closed.  Use the writer as a context manager:
+
+            with db_manager.writer() as writer:
+                for image in images:
+                    writer.add_image(image)
+        """
+        return ImageDbWriter(self, max_records=max_records, max_bytes=max_bytes)
+
+    def encode_image(self, image):
+        """
+        Encodes an image for the main, cells, crops, maps and summaries databases.  Encoding doesn't use the
+         database, so images can be encoded in other processes and written with ImageDbWriter.add_encoded_image
+
+        Returns a list of (key, value, db_name, overwrite) tuples, db_name is None for the main database
+        """
+        key = self._get_key(image.source_path)
+        puts = list()
+
+        # The descriptor is stored without it's cells and maps, they're stored in the crops and maps databases
+        descriptor = copy.copy(image)
+        descriptor.cells = []
+        descriptor.set_map_loader(None)
+        for map_name in self.map_names:
+            map_key, map_put = self._encode_map(image, map_name)
+            descriptor.set_map_key(map_name, map_key)
+            if map_put is not None:
+                puts.append(map_put)
+
+        cell_table = image.get_cell_table()
+        cell_table_data = serialization.dumps(cell_table)
+        image_puts = [(key, self._dumps(descriptor), None, True),
+                      (key, encode_record(cell_table_data, self.codec), self.cells_db_name, True),
+                      (key, self._dumps(image.cells), self.crops_db_name, True)]
+        byte_size = sum(len(value) for _, value, _, _ in image_puts)
+
+        summary = self._get_summary(cell_table, byte_size, hashlib.sha256(cell_table_data).hexdigest())
+        puts.extend(image_puts)
+        puts.append((key, json.dumps(summary), self.summaries_db_name, True))
+        return puts
+
+    @staticmethod
+    def _get_summary(cell_table, byte_size, content_hash):
+        """
+        Summarizes an image for the summaries database, from it's cell table, the size of it's encoded records
+         and the sha256 of it's serialized cell table
+        """
+        # dataframes imports this module
+        from experiment_handling import dataframes
+
+        source_path = cell_table['source_path']
+        try:
+            animal, slide = dataframes.get_animal(source_path), dataframes.get_slide(source_path)
+        except IndexError:
+            animal, slide = None, None
+
+        return {
+            'source_path': source_path,
+            'depth': numpy.asarray(cell_table['depth']).tolist(),
+            'cell_count': len(cell_table['cells']),
+            'vsi_resolution': numpy.asarray(cell_table['vsi_resolution']).tolist(),
+            'condition': dataframes.parse_class(source_path),
+            'animal': animal,
+            'slide': slide,
+            'byte_size': byte_size,
+            'content_hash': content_hash
+        }
+
+    def _encode_map(self, image, map_name):
+        """
+        Encodes one of an image's maps for the maps database
+
+        Returns the key that the map is stored under, and the put that stores it.  The put is None if the map is
+         already stored, or if the image has no map.  Maps are never overwritten, since identical maps share a key
+        """
+        # Maps that haven't been loaded from this database can't have changed.  Maps of images read from another
+        #  database are loaded from it and stored in this one
+        map_key = image.get_map_key(map_name)
+        if map_key is not None and self._has_map(image, map_key):
+            return map_key, None
+
+        map_array = getattr(image, map_name)
+        if map_array is None:
+            return None, None
+
+        # Maps are keyed by their uncompressed contents, so identical maps share a key regardless of codec
+        map_data = serialization.dumps(numpy.asarray(map_array))
+        map_key = hashlib.sha256(map_data).hexdigest()
+        return map_key, (map_key, encode_record(map_data, self.codec), self.maps_db_name, False)
+
+    def _dumps(self, obj):
+        """
+        Serializes obj (see serialization.dumps) and encodes it with this manager's codec
+        """
+        return encode_record(serialization.dumps(obj), self.codec)
+
+    @staticmethod
+    def _loads(data):
+        """
+        Decodes and deserializes a record read from the database.  Records written before the serialization format
+         was added are unpickled
+        """
+        record = decode_record(data)
+        if serialization.is_serialized(record):
+            return serialization.loads(record)
+        return pickle.loads(record)
+
+    def _write_puts(self, txn, puts):
+        """
+        Writes puts returned by encode_image in the given write transaction
+        """
+        for key, value, db_name, overwrite in puts:
+            txn.put(key, value, overwrite=overwrite, db=self._sub_dbs[db_name] if db_name is not None else None)
+
+    def _has_map(self, image, map_key):
+        """
+        Returns True if the map of image that's stored under map_key is stored in this database
+        """
+        loader = image.get_map_loader()
+        if getattr(loader, '__self__', None) is self:
+            return True
+        if self._maps_db is None:
+            return False
+
+        with self._db.begin() as txn:
+            return txn.get(map_key, db=self._maps_db) is not None
+
+    def _load_map(self, map_key):
+        """
+        Loads the map stored under map_key in the maps database.  Raises a KeyError if it isn't stored
+        """
+        with self._db.begin() as txn:
+            map_data = txn.get(map_key, db=self._maps_db) if self._maps_db is not None else None
+        if map_data is None:
+            raise KeyError('Map %s is not stored in %s' % (map_key, self._db.path()))
+        return self._loads(map_data)
+
+    def migrate_records(self, batch_size=100):
+        """
+        Rewrites every record in the database that isn't already serialized (see serialization) and encoded with
+         this manager's codec.  Images stored before cells and maps were stored separately are split into the
+         cells, crops and maps databases.  Records are rewritten in place, under the same keys
+
+        Returns the number of records that were rewritten
+        """
+        puts = list()
+        num_rewritten = 0
+        with self._db.begin() as txn:
+            for key, image_data in txn.cursor():
+                if key in self._sub_db_names:
+                    continue
+
+                if self._cells_db is not None and txn.get(key, default=None, db=self._cells_db) is None:
+                    # Legacy images hold their cells and maps
+                    puts.extend(self.encode_image(self._load_image(txn, key, image_data)))
+                    num_rewritten += 1
+                elif not self._is_current_record(image_data):
+                    puts.append((key, self._dumps(self._loads(image_data)), None, True))
+                    num_rewritten += 1
+
+                if len(puts) >= batch_size:
+                    self._commit_puts(puts)
+                    puts = list()
+
+            for db_name in (self.cells_db_name, self.crops_db_name, self.maps_db_name):
+                for key, value in txn.cursor(db=self._sub_dbs[db_name]):
+                    if not self._is_current_record(value):
+                        puts.append((key, self._dumps(self._loads(value)), db_name, True))
+                        num_rewritten += 1
+
+                    if len(puts) >= batch_size:
+                        self._commit_puts(puts)
+                        puts = list()
+
+        self._commit_puts(puts)
+        return num_rewritten
+
+    def _is_current_record(self, data):
+        return get_record_codec(data) == self.codec and serialization.is_serialized(decode_record(data))
+
+    def _commit_puts(self, puts):
+        with self._db.begin(write=True) as txn:
+            self._write_puts(txn, puts)
+
+    def ingest_image_files(self, file_paths, processes=None, max_records=100, max_bytes=2**28):
+        """
+        Adds pickled image descriptors (e.g. the _detectedCells.p files written by pickle_cells_from_metadata.py)
+         to the database.  Files are loaded, validated and encoded by a pool of worker processes, and written
+         in batches by an ImageDbWriter (see writer).  The size and modification time of each file is committed
+         along with it's image, see get_files_to_ingest
+
+        Returns an iterator that returns a tuple (file_path, error) for each file, in the order they're finished.
+         error is None if the file was ingested, otherwise it describes why the file couldn't be ingested.
+         Buffered images are committed when the iterator is exhausted or closed
+
+        :param file_paths: Paths to the pickled image descriptors
+        :param processes: The number of worker processes to use, defaults to the number of cpus
+        :param max_records: See writer
+        :param max_bytes: See writer
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+
+        pool = multiprocessing.Pool(processes, initializer=_init_encoding_worker, initargs=(self.codec,))
+        try:
+            with self.writer(max_records=max_records, max_bytes=max_bytes) as writer:
+                records = ((file_path, self.ingested_db_name) for file_path in file_paths)
+                for file_path, puts, error in _bounded_parallel_map(pool, _encode_image_file_in_worker, records,
+                                                                    ordered=False, prefetch=2 * processes):
+                    if puts is not None:
+                        writer.add_encoded_image(puts)
+                    yield file_path, error
+
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def get_files_to_ingest(self, file_paths):
+        """
+        Returns the file paths that haven't been ingested (see ingest_image_files), or whose size or modification
+         time have changed since they were ingested
+        """
+        if self._ingested_db is None:
+            return list(file_paths)
+
+        files_to_ingest = list()
+        with self._db.begin() as txn:
+            for file_path in file_paths:
+                ingested_data = txn.get(os.path.abspath(file_path), default=None, db=self._ingested_db)
+                if ingested_data is None or json.loads(ingested_data) != _get_file_stat(file_path):
+                    files_to_ingest.append(file_path)
+
+        return files_to_ingest
+
+    def get_summary(self, source_path):
+        """
+        Get the summary of the image with the given source_path, a dict with the image's 'source_path', 'depth',
+         'cell_count', 'vsi_resolution', the 'condition', 'animal' and 'slide' parsed from it's source path
+         (see dataframes), the 'byte_size' of it's encoded records, not including it's maps, and the
+         'content_hash' of it's cell table, which changes whenever the image's cells are changed
+
+        Returns None if the specified image could not be found
+        """
+        self._check_summaries_db()
+        with self._db.begin() as txn:
+            summary_data = txn.get(self._get_key(source_path), default=None, db=self._summaries_db)
+        if summary_data is None:
+            return None
+        return json.loads(summary_data)
+
+    def get_summary_iter(self):
+        """
+        Returns an iterator that returns the summary (see get_summary) of each image in the database,
+         only reading the summaries database
+
+        This opens a database transaction for the duration of the iterator
+        """
+        self._check_summaries_db()
+        with self._db.begin() as txn:
+            for summary_data in txn.cursor(db=self._summaries_db).iternext(keys=False, values=True):
+                yield json.loads(summary_data)
+
+    def get_summaries(self, predicate=None, **criteria):
+        """
+        Returns a list of the summaries (see get_summary) that satisfy predicate, and whose values equal
+         the given criteria.  e.g. get_summaries(lambda s: s['depth'] > 200, condition='Shock')
+        """
+        return [summary for summary in self.get_summary_iter()
+                if all(summary.get(name) == value for name, value in criteria.iteritems())
+                and (predicate is None or predicate(summary))]
+
+    def rebuild_summaries(self, batch_size=1000):
+        """
+        Rewrites the summary of every image in the database, e.g. for images added before summaries were stored.
+         Only cell tables are decoded, except for images stored before cells were stored separately
+
+        Returns the number of summaries that were written
+        """
+        puts = list()
+        num_written = 0
+        with self._db.begin() as txn:
+            for key, image_data in txn.cursor():
+                if key in self._sub_db_names:
+                    continue
+
+                byte_size = len(image_data) + sum(len(txn.get(key, default='', db=db))
+                                                  for db in (self._cells_db, self._crops_db))
+                cell_table = self._load_cell_table(txn, key)
+                content_hash = hashlib.sha256(serialization.dumps(cell_table)).hexdigest()
+                summary = self._get_summary(cell_table, byte_size, content_hash)
+                puts.append((key, json.dumps(summary), self.summaries_db_name, True))
+                num_written += 1
+
+                if len(puts) >= batch_size:
+                    self._commit_puts(puts)
+                    puts = list()
+
+        self._commit_puts(puts)
+        return num_written
+
+    def _check_summaries_db(self):
+        if self._summaries_db is None:
+            raise RuntimeError('This database has no summaries, open it with readonly=False and call rebuild_summaries')
+
+    def remove_unreferenced_maps(self):
+        """
+        Deletes maps that are no longer referenced by any image, e.g. after images' maps have been replaced
+
+        Returns the number of maps that were deleted
+        """
+        with self._db.begin(write=True) as txn:
+            referenced_keys = set()
+            for key, image_data in txn.cursor():
+                if key not in self._sub_db_names:
+                    image = self._loads(image_data)
+                    referenced_keys.update(image.get_map_key(map_name) for map_name in self.map_names)
+
+            unreferenced_keys = [map_key for map_key in txn.cursor(db=self._maps_db).iternext(values=False)
+                                 if map_key not in referenced_keys]
+            for map_key in unreferenced_keys:
+                txn.delete(map_key, db=self._maps_db)
+
+        return len(unreferenced_keys)
 
     def get_image(self, source_path):
         """
@@ -42,11 +496,35 @@ class ImageDbManager(object):
         
         Returns None if the specified image could not be found
         """
-        key = hashlib.sha256(source_path).hexdigest()
+        key = self._get_key(source_path)
         with self._db.begin() as txn:
             image_data = txn.get(key, default=None)
+            if image_data is None:
+                return None
+            return self._load_image(txn, key, image_data)
 
-        return pickle.loads(image_data)
+    def get_images(self, source_paths, lazy=False):
+        """
+        Get data for many images at once, reading them all in a single transaction
+
+        If lazy is True, records are read ahead but not decoded: an ImageRecord is returned for each image,
+         which decodes the image the first time ImageRecord.image is accessed
+
+        Returns a list with an image (or ImageRecord) for each source path, None for images that could not be found
+        """
+        images = list()
+        with self._db.begin() as txn:
+            for source_path in source_paths:
+                key = self._get_key(source_path)
+                image_data = txn.get(key, default=None)
+                if image_data is None:
+                    images.append(None)
+                elif lazy:
+                    images.append(ImageRecord(self, source_path, image_data, self._get_cell_data(txn, key)))
+                else:
+                    images.append(self._decode_image(image_data, self._get_cell_data(txn, key)))
+
+        return images
 
     def get_image_iter(self):
         """
@@ -56,8 +534,350 @@ class ImageDbManager(object):
             (i.e. until all images have been exhausted)
         """
         with self._db.begin() as txn:
-            for _, data in txn.cursor():
-                yield pickle.loads(data)
+            for key, data in txn.cursor():
+                if key not in self._sub_db_names:
+                    yield self._load_image(txn, key, data)
+
+    def get_image_iter_parallel(self, map_function=None, processes=None, ordered=True, prefetch=None):
+        """
+        Returns an iterator that decodes images from the database in a pool of worker processes.
+
+        Raw records are read from the database in this process and sent to the workers, which unpickle them and
+         call map_function on each image, so that per image reductions also run in the workers.
+        Each worker opens it's own read only handle to the database to load maps from.
+        :param map_function: A function called on each image in the workers.  If given, it's results are returned
+            instead of the images.  It must be picklable, i.e. defined at the top level of a module
+        :param processes: The number of worker processes.  Defaults to the number of cpus
+        :param ordered: If True, results are returned in the order that the images are stored in.
+            Otherwise they are returned as soon as they are ready
+        :param prefetch: The maximum number of records that are read ahead of the results that have been returned.
+            Defaults to 4 per worker process
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if prefetch is None:
+            prefetch = 4 * processes
+
+        # The pool is started before the read transaction, so the workers don't inherit it
+        pool = multiprocessing.Pool(processes, initializer=_init_decoding_worker, initargs=(self._db.path(),))
+        try:
+            with self._db.begin() as txn:
+                records = ((image_data, self._get_cell_data(txn, key), map_function)
+                           for key, image_data in txn.cursor() if key not in self._sub_db_names)
+
+                for result in _bounded_parallel_map(pool, _decode_image_in_worker, records, ordered, prefetch):
+                    if map_function is None:
+                        result.set_map_loader(self._load_map)
+                    yield result
+
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _load_image(self, txn, key, image_data):
+        """
+        Unpickles an image descriptor read from the main database, and attaches it's cells from the crops database.
+        It's maps are loaded from the maps database when they are first accessed
+        """
+        return self._decode_image(image_data, self._get_cell_data(txn, key))
+
+    def _get_cell_data(self, txn, key):
+        """
+        Reads the pickled cells of an image from the crops database, None if they aren't stored there
+        """
+        if self._crops_db is None:
+            return None
+        return txn.get(key, default=None, db=self._crops_db)
+
+    def _decode_image(self, image_data, cell_data):
+        """
+        Decodes an image descriptor and it's cells, read from the main and crops databases
+        """
+        image = self._loads(image_data)
+        image.set_map_loader(self._load_map)
+        if cell_data is not None:
+            image.cells = self._loads(cell_data)
+        return image
+
+    def get_cell_table(self, source_path):
+        """
+        Get the cell table (see ImageDescriptor.get_cell_table) for the image with the given source_path,
+         without reading the cells' image crops
+
+        Returns None if the specified image could not be found
+        """
+        key = self._get_key(source_path)
+        with self._db.begin() as txn:
+            return self._load_cell_table(txn, key)
+
+    def get_cell_table_iter(self):
+        """
+        Returns an iterator that returns the cell table (see ImageDescriptor.get_cell_table) of each image
+         in the database.  Only the cells database is read, except for images stored before cells were stored
+         separately, which have to be loaded in full
+
+        This opens a database transaction for the duration of the iterator
+        """
+        with self._db.begin() as txn:
+            for key in txn.cursor().iternext(keys=True, values=False):
+                if key not in self._sub_db_names:
+                    yield self._load_cell_table(txn, key)
+
+    def _load_cell_table(self, txn, key):
+        if self._cells_db is not None:
+            cell_table_data = txn.get(key, default=None, db=self._cells_db)
+            if cell_table_data is not None:
+                return self._loads(cell_table_data)
+
+        image_data = txn.get(key, default=None)
+        if image_data is None:
+            return None
+        return self._load_image(txn, key, image_data).get_cell_table()
+
+
+class ImageDbWriter(object):
+    """
+    Buffers images added to an ImageDbManager, and writes them in batches.  Create these with ImageDbManager.writer
+
+    Images are encoded when they're added, so only their encoded data is held in memory.  The buffer is committed
+     in a single transaction whenever it holds max_records images or max_bytes of encoded data, and when the writer
+     is closed, which happens automatically when it's used as a context manager
+    """
+
+    def __init__(self, db_manager, max_records=100, max_bytes=2**28):
+        self._db_manager = db_manager
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+
+        self._pending_puts = list()
+        self._pending_map_keys = set()
+        self.pending_records = 0
+        self.pending_bytes = 0
+
+        self.committed_records = 0
+        self.committed_bytes = 0
+        self.commits = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        # Images that were added before an exception are still written
+        self.close()
+        return False
+
+    def add_image(self, image):
+        """
+        Add an image to the buffer, this will overwrite any existing image with the same source path once committed
+        """
+        self.add_encoded_image(self._db_manager.encode_image(image))
+
+    def add_encoded_image(self, puts):
+        """
+        Add an image encoded with ImageDbManager.encode_image to the buffer, along with any other puts
+         that should be committed with it
+        """
+        for key, value, db_name, overwrite in puts:
+            # Maps shared by several buffered images only need to be written once
+            if not overwrite:
+                if key in self._pending_map_keys:
+                    continue
+                self._pending_map_keys.add(key)
+
+            self._pending_puts.append((key, value, db_name, overwrite))
+            self.pending_bytes += len(value)
+
+        self.pending_records += 1
+        if self.pending_records >= self.max_records or self.pending_bytes >= self.max_bytes:
+            self.flush()
+
+    def add_image_sequence(self, image_seq):
+        """
+        Add each image in a sequence to the buffer
+        """
+        for image in image_seq:
+            self.add_image(image)
+
+    def flush(self):
+        """
+        Commit all buffered images to the database
+        """
+        if not self._pending_puts:
+            return
+
+        with self._db_manager._db.begin(write=True) as txn:
+            self._db_manager._write_puts(txn, self._pending_puts)
+
+        self.committed_records += self.pending_records
+        self.committed_bytes += self.pending_bytes
+        self.commits += 1
+
+        self._pending_puts = list()
+        self._pending_map_keys = set()
+        self.pending_records = 0
+        self.pending_bytes = 0
+
+    def close(self):
+        self.flush()
+
+    def get_stats(self):
+        """
+        Returns a dict of the writer's counters
+        """
+        return {'committed_records': self.committed_records,
+                'committed_bytes': self.committed_bytes,
+                'commits': self.commits,
+                'pending_records': self.pending_records,
+                'pending_bytes': self.pending_bytes}
+
+
+class ImageRecord(object):
+    """
+    A record read from an ImageDbManager, that isn't decoded until it's image is accessed
+    """
+
+    def __init__(self, db_manager, source_path, image_data, cell_data):
+        self.source_path = source_path
+        self._db_manager = db_manager
+        self._image_data = image_data
+        self._cell_data = cell_data
+        self._image = None
+
+    @property
+    def image(self):
+        """
+        The image descriptor stored in this record, decoded on first access
+        """
+        if self._image is None:
+            self._image = self._db_manager._decode_image(self._image_data, self._cell_data)
+            self._image_data = self._cell_data = None
+        return self._image
+
+    @property
+    def is_decoded(self):
+        return self._image is not None
+
+
+# Each process in the pool used by ImageDbManager.get_image_iter_parallel opens it's own handle to the database
+_worker_db_manager = None
+
+
+def _init_decoding_worker(db_path):
+    global _worker_db_manager
+    _worker_db_manager = ImageDbManager(db_path, readonly=True)
+
+
+def _decode_image_in_worker(record):
+    """
+    Decodes an image in a worker process, and applies map_function to it if given
+
+    Returns a tuple (succeeded, result).  Failures return the formatted traceback instead of raising, since
+     exceptions re-raised from the pool lose the worker's traceback.  _bounded_parallel_map raises it in the caller
+    """
+    image_data, cell_data, map_function = record
+    try:
+        image = _worker_db_manager._decode_image(image_data, cell_data)
+        if map_function is not None:
+            return True, map_function(image)
+
+        # The image's maps are loaded from the database by the receiving process, rather than pickled with the image
+        image.set_map_loader(None)
+        return True, image
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def _init_encoding_worker(codec):
+    global _worker_db_manager
+    _worker_db_manager = _ImageEncoder(codec)
+
+
+class _ImageEncoder(ImageDbManager):
+    """
+    An ImageDbManager without a database, that can only encode images
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+        self._db = None
+        self._maps_db = None
+
+
+def _get_file_stat(file_path):
+    file_stat = os.stat(file_path)
+    return {'size': file_stat.st_size, 'mtime': file_stat.st_mtime}
+
+
+def _encode_image_file_in_worker(record):
+    """
+    Loads, validates and encodes a pickled image descriptor in a worker process
+
+    Returns a tuple (True, (file_path, puts, error)).  puts is None if the file couldn't be ingested, in which case
+     error is the formatted exception.  The file's stat is read before it's loaded, so files modified while they're
+     ingested will be ingested again
+    """
+    file_path, ingested_db_name = record
+    try:
+        file_stat = _get_file_stat(file_path)
+        with open(file_path, 'rb') as image_file:
+            image = pickle.load(image_file)
+
+        # Validate the image before anything is written
+        if not hasattr(image, 'get_cell_table') or not hasattr(image, 'source_path'):
+            raise TypeError('%s does not contain an image descriptor' % file_path)
+        if image.region_map is None or image.hemisphere_map is None:
+            raise ValueError('%s is missing it\'s region or hemisphere map' % file_path)
+
+        puts = _worker_db_manager.encode_image(image)
+        puts.append((os.path.abspath(file_path), json.dumps(file_stat), ingested_db_name, True))
+        return True, (file_path, puts, None)
+    except Exception:
+        return True, (file_path, None, traceback.format_exc())
+
+
+def _bounded_parallel_map(pool, function, items, ordered, prefetch):
+    """
+    Applies function to items in pool, keeping at most prefetch items in flight, and yields the results
+
+    function must return a tuple (succeeded, result), as _decode_image_in_worker does
+    """
+    def unpack(outcome):
+        succeeded, result = outcome
+        if not succeeded:
+            raise RuntimeError('Worker process failed:\n' + result)
+        return result
+
+    if ordered:
+        pending = deque()
+        for item in items:
+            pending.append(pool.apply_async(function, (item,)))
+            if len(pending) >= prefetch:
+                yield unpack(pending.popleft().get())
+        while pending:
+            yield unpack(pending.popleft().get())
+    else:
+        pending = list()
+        for item in items:
+            pending.append(pool.apply_async(function, (item,)))
+            if len(pending) >= prefetch:
+                yield unpack(_pop_finished(pending).get())
+        while pending:
+            yield unpack(_pop_finished(pending).get())
+
+
+def _pop_finished(pending, poll_interval=0.01):
+    """
+    Removes and returns the first ready AsyncResult in pending, waiting until one is
+
+    Results are polled rather than collected with callbacks, since callbacks never run for tasks that fail in the
+     pool itself (e.g. when the task or it's result can't be pickled), and get() raises those failures
+    """
+    while True:
+        for i, result in enumerate(pending):
+            if result.ready():
+                return pending.pop(i)
+        pending[0].wait(poll_interval)
 
 
 class MetadataManager():
@@ -65,34 +885,234 @@ class MetadataManager():
     A class to manage the metadata.json file used in the image registration pipeling
 
     I handle loading, and updating the data in metadata.json
+
+    Lookups by attribute and by name use indexes that are built the first time each is needed.  They're rebuilt
+     when the metadata is loaded, updated or replaced.  Call invalidate_indexes after modifying entries in place
+
+    Changes to single entries can be recorded with patch_entry, which appends them to a journal next to
+     metadata.json (metadata.json.journal) instead of rewriting it.  Patches in the journal are applied whenever the
+     metadata is loaded, and merged into metadata.json once the journal grows past max_journal_size.  Reads and
+     writes of both files hold a lock on metadata.json.lock, so many processes can patch entries concurrently.
+     update_metadata only writes the changes made to self.metadata since it was loaded, so it keeps the changes
+     other processes made in the meantime
     """
 
     metadata = None
 
+    # The journal is compacted into metadata.json once it's larger than this many bytes
+    max_journal_size = 2**20
+
+    # Patches in the journal identify the entry they modify by this attribute
+    journal_key = 'vsiPath'
+
+    # Copies of the entries as they were loaded (or last saved), by journal_key, to find the changes to self.metadata
+    _loaded_entries = None
+
+    # Indexes map attribute values to the first entry with that value, _indexed_metadata is the list they index
+    _indexes = None
+    _indexed_metadata = None
+
     def __init__(self, experiment_path=os.getcwd()):
         self.experimentPath = experiment_path
         self.metadataPath = self.generate_metadata_path(experiment_path)
+        self.journalPath = self.metadataPath + '.journal'
+        self.lockPath = self.metadataPath + '.lock'
         self.load_metadata()
 
     def load_metadata(self):
         """
-        Loads the metadata from metadata.json and stores it at self.json
+        Loads the metadata from metadata.json, applies the patches in the journal, and stores it at self.metadata
         :return: Pointer to self.metadata
         """
-        json_file = open(self.metadataPath, 'r')
-        self.metadata = json.load(json_file)
-        json_file.close()
+        with self._lock(exclusive=False):
+            self._read_metadata()
         return self.metadata
 
     def update_metadata(self):
         """
         Updates the data stored at metadata.json with the data in self.metadata
+
+        Only the changes made to self.metadata since it was loaded are written.  They're merged into the metadata
+         currently on disk, including the journal, so changes that other processes made in the meantime are kept
+         (even if they've since been compacted into metadata.json), and are applied to self.metadata
         :return: zilch
         """
-        json_file = open(self.metadataPath, 'w')
-        json.dump(self.metadata, json_file, sort_keys=True, indent=4)
+        with self._lock(exclusive=True):
+            changes = self._get_changes()
+            self._read_metadata()
+            self._apply_changes(changes)
+
+            self._write_metadata(self.metadata)
+            if os.path.exists(self.journalPath):
+                os.remove(self.journalPath)
+            self._take_snapshot()
+        self.invalidate_indexes()
+
+    def patch_entry(self, key, patch):
+        """
+        Updates the entry whose journal_key attribute equals key with the values in the dict patch, in self.metadata
+         and in the journal.  An entry is added if none matches.  Compacts the journal if it's grown too large
+
+        Unlike update_metadata, this is safe to use from many processes at once
+        """
+        patch = {'key': key, 'values': patch}
+        with self._lock(exclusive=True):
+            with open(self.journalPath, 'a+') as journal_file:
+                # Terminate a partial line left by a process that was killed while writing it, so that it's skipped
+                #  on its own rather than corrupting this patch
+                journal_file.seek(0, os.SEEK_END)
+                if journal_file.tell() > 0:
+                    journal_file.seek(-1, os.SEEK_END)
+                    if journal_file.read(1) != '\n':
+                        journal_file.write('\n')
+                journal_file.write(json.dumps(patch) + '\n')
+            self._apply_patch(patch)
+            self._loaded_entries.setdefault(key, {self.journal_key: key}).update(copy.deepcopy(patch['values']))
+
+            if os.path.getsize(self.journalPath) > self.max_journal_size:
+                # Compacting reloads the metadata, which would discard changes to self.metadata that aren't saved
+                metadata, loaded_entries = self.metadata, self._loaded_entries
+                self._compact()
+                self.metadata, self._loaded_entries = metadata, loaded_entries
+        self.invalidate_indexes()
+
+    def compact_metadata(self):
+        """
+        Merges the patches in the journal into metadata.json, and removes the journal
+        """
+        with self._lock(exclusive=True):
+            self._compact()
+        return self.metadata
+
+    def _compact(self):
+        # The lock must be held
+        self._read_metadata()
+        self._write_metadata(self.metadata)
+        if os.path.exists(self.journalPath):
+            os.remove(self.journalPath)
+
+    def _read_metadata(self):
+        # The lock must be held
+        json_file = open(self.metadataPath, 'r')
+        self.metadata = json.load(json_file)
         json_file.close()
 
+        for patch in self._read_journal():
+            self._apply_patch(patch)
+        self._take_snapshot()
+        self.invalidate_indexes()
+
+    def _take_snapshot(self):
+        self._loaded_entries = dict()
+        for entry in self.metadata:
+            if self.journal_key in entry:
+                self._loaded_entries.setdefault(entry[self.journal_key], copy.deepcopy(entry))
+
+    def _get_changes(self):
+        """
+        Compares self.metadata to the entries it was loaded with
+
+        Returns a tuple (changes, removed_keys, keyless_entries).  changes is a list of tuples (key, values, deleted),
+         the journal_key of a new or changed entry, a dict of it's new and changed attributes, and the names of it's
+         deleted attributes.  Entries without a journal_key can't be compared, so they're returned as they are
+        """
+        changes = list()
+        keys = set()
+        keyless_entries = list()
+        for entry in self.metadata:
+            if self.journal_key not in entry:
+                keyless_entries.append(entry)
+                continue
+
+            key = entry[self.journal_key]
+            keys.add(key)
+            loaded_entry = self._loaded_entries.get(key)
+            if loaded_entry is None:
+                changes.append((key, entry, []))
+                continue
+
+            values = dict((name, value) for name, value in entry.iteritems()
+                          if name not in loaded_entry or loaded_entry[name] != value)
+            deleted = [name for name in loaded_entry if name not in entry]
+            if values or deleted:
+                changes.append((key, values, deleted))
+
+        removed_keys = [key for key in self._loaded_entries if key not in keys]
+        return changes, removed_keys, keyless_entries
+
+    def _apply_changes(self, changes):
+        """
+        Applies changes returned by _get_changes to self.metadata
+        """
+        changes, removed_keys, keyless_entries = changes
+        for key, values, deleted in changes:
+            self._apply_patch({'key': key, 'values': values})
+            entry = self.get_entry_by_attribute(self.journal_key, key)
+            for name in deleted:
+                entry.pop(name, None)
+
+        removed_keys = set(removed_keys)
+        self.metadata = [entry for entry in self.metadata
+                         if self.journal_key in entry and entry[self.journal_key] not in removed_keys]
+        self.metadata += keyless_entries
+        self.invalidate_indexes()
+
+    def _write_metadata(self, metadata):
+        with files.open_atomically(self.metadataPath) as metadata_file:
+            metadata_file.write(json.dumps(metadata, sort_keys=True, indent=4))
+
+    def _read_journal(self):
+        """
+        Returns the patches in the journal.  A partially written last line (e.g. from a process that was killed
+         while writing it) is ignored
+        """
+        try:
+            journal_file = open(self.journalPath, 'r')
+        except IOError:
+            return []
+
+        with journal_file:
+            lines = journal_file.read().split('\n')
+
+        # The last line is empty if the journal ends with a complete patch
+        patches = list()
+        for line in lines[:-1]:
+            try:
+                patches.append(json.loads(line))
+            except ValueError:
+                # A partial line that was followed by another patch
+                warn('Skipping corrupt patch in %s: %s' % (self.journalPath, line))
+        return patches
+
+    def _apply_patch(self, patch):
+        entry = self.get_entry_by_attribute(self.journal_key, patch['key'])
+        if entry is None:
+            entry = {self.journal_key: patch['key']}
+            self.metadata.append(entry)
+            self.invalidate_indexes()
+        entry.update(patch['values'])
+
+    @contextmanager
+    def _lock(self, exclusive):
+        """
+        Holds a lock on the lock file while the context is active.  Metadata in read only experiments is read
+         without a lock
+        """
+        try:
+            lock_file = open(self.lockPath, 'a+')
+        except IOError:
+            if exclusive:
+                raise
+            yield
+            return
+
+        try:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+        finally:
+            fcntl.lockf(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
     def ensure_metadata_directory(self):
         """
         Creates self.experimentPath/.registrationData if it doesn't exist
@@ -116,14 +1136,22 @@ class MetadataManager():
 
         retuns None if no entry is found
         """
-        for entry in self.metadata:
-            try:
-                if entry[attribute] == value:
+        try:
+            return self._get_index(attribute).get(value)
+        except TypeError:
+            # Unhashable values can't be indexed
+            for entry in self.metadata:
+                if attribute in entry and entry[attribute] == value:
                     return entry
-            except KeyError as e:
-                pass
+            return None
 
-        return None
+    def get_entry_by_basename(self, basename):
+        """
+        Searches self.metadata for the entry where the basename of entry['vsiPath'] == basename
+
+        retuns None if no entry is found
+        """
+        return self._get_index('vsiPath', key=os.path.basename).get(basename)
 
     def get_entry_from_name(self, name):
         """
@@ -131,6 +1159,11 @@ class MetadataManager():
 
         retuns None if no entry is found
         """
+        # Names are usually basenames, which are indexed
+        entry = self.get_entry_by_basename(name)
+        if entry is not None:
+            return entry
+
         for entry in self.metadata:
             if name in entry['vsiPath']:
                 return entry
@@ -138,6 +1171,33 @@ class MetadataManager():
         print "No Entry Found for image %s" % name
         return None
 
+    def invalidate_indexes(self):
+        """
+        Discards the indexes used for lookups, they're rebuilt when they're next needed
+        """
+        self._indexes = dict()
+        self._indexed_metadata = self.metadata
+
+    def _get_index(self, attribute, key=None):
+        """
+        Returns a dict mapping key(entry[attribute]) to the first entry with that value, building it if needed
+        """
+        if self._indexes is None or self._indexed_metadata is not self.metadata:
+            self.invalidate_indexes()
+
+        index_name = (attribute, key)
+        if index_name not in self._indexes:
+            index = dict()
+            for entry in self.metadata:
+                try:
+                    value = entry[attribute]
+                    index.setdefault(value if key is None else key(value), entry)
+                except (KeyError, TypeError):
+                    pass
+            self._indexes[index_name] = index
+
+        return self._indexes[index_name]
+
 
 
 def _ensure_dir(dir_path):
@@ -158,6 +1218,8 @@ data_type_key = {
     'MET_UINT': numpy.uintc,
     'MET_FLOAT': numpy.single,
     'MET_DOUBLE': numpy.double,
+    'MET_LONG_LONG': numpy.longlong,
+    'MET_ULONG_LONG': numpy.ulonglong,
     numpy.byte: 'MET_CHAR',
     numpy.ubyte: 'MET_UCHAR',
     numpy.short: 'MET_SHORT',
@@ -165,52 +1227,224 @@ data_type_key = {
     numpy.intc: 'MET_INT',
     numpy.uintc: 'MET_UINT',
     numpy.single: 'MET_FLOAT',
-    numpy.double: 'MET_DOUBLE'}
+    numpy.double: 'MET_DOUBLE',
+    numpy.longlong: 'MET_LONG_LONG',
+    numpy.ulonglong: 'MET_ULONG_LONG'}
 
 # The order for these is important
-accepted_tags = ('ObjectType','NDims','BinaryData','BinaryDataByteOrderMSB','CompressedData','CompressedDataSize',
-                 'TransformMatrix','Offset','CenterOfRotation','AnatomicalOrientation','ElementSpacing','DimSize',
-                 'ElementType','ElementDataFile','Comment','SeriesDescription','AcquisitionDate','AcquisitionTime',
-                 'StudyDate','StudyTime')
+accepted_tags = ('ObjectType','NDims','BinaryData','BinaryDataByteOrderMSB','ElementByteOrderMSB','CompressedData',
+                 'CompressedDataSize','TransformMatrix','Offset','CenterOfRotation','AnatomicalOrientation',
+                 'ElementSpacing','DimSize','HeaderSize','ElementType','ElementDataFile','Comment','SeriesDescription',
+                 'AcquisitionDate','AcquisitionTime','StudyDate','StudyTime')
 
 
 def load_mhd_header(file_path):
     """ Return a dictionary of meta data from meta header file """
-    header_file = open(file_path, "r")
+    return _read_mhd_header(file_path)[0]
+
 
+def _read_mhd_header(file_path):
+    """
+    Reads the header of an mhd file.  Parsing stops at ElementDataFile, which is always the last tag,
+     since the image data follows it in files whose ElementDataFile is LOCAL
+
+    Returns a tuple (meta_dict, header_length), header_length is the number of bytes up to the end of
+     the ElementDataFile line
+    """
     meta_dict = {}
-    for line in header_file:
-        tag, value = line.split(' = ')
-        if tag in accepted_tags:
-            meta_dict[tag.strip()] = value.strip()
+    with open(file_path, 'rb') as header_file:
+        for line in iter(header_file.readline, ''):
+            tag, _, value = line.partition('=')
+            tag = tag.strip()
+            if tag in accepted_tags:
+                meta_dict[tag] = value.strip()
+            elif tag:
+                warn('Encountered unexpected tag: ' + tag)
+
+            if tag == 'ElementDataFile':
+                break
+        header_length = header_file.tell()
+
+    return meta_dict, header_length
+
+
+def _get_mhd_data_layout(file_path, meta_dict, header_length):
+    """
+    Locates the image data described by an mhd header
+
+    Returns a tuple (data_filepath, dtype, shape, offset), where dtype has the byte order of the data file
+     and offset is the position of the image data in the data file
+    """
+    shape = tuple(map(int, meta_dict['DimSize'].split()))
+    data_type = numpy.dtype(data_type_key[meta_dict['ElementType'].upper()])
+
+    msb = meta_dict.get('BinaryDataByteOrderMSB', meta_dict.get('ElementByteOrderMSB', 'False'))
+    data_type = data_type.newbyteorder('>' if msb.lower() == 'true' else '<')
+
+    if meta_dict['ElementDataFile'] == 'LOCAL':
+        data_filepath, offset = file_path, header_length
+    else:
+        data_filepath, offset = os.path.join(os.path.dirname(file_path), meta_dict['ElementDataFile']), 0
+
+    header_size = int(meta_dict.get('HeaderSize', 0))
+    if header_size == -1:
+        # The image data is at the end of the file, after a header of unknown size
+        if _is_compressed(meta_dict):
+            data_size = int(meta_dict['CompressedDataSize'])
         else:
-            warn('Encountered unexpected tag: ' + tag)
-    header_file.close()
+            data_size = int(numpy.prod(shape)) * data_type.itemsize
+        offset = os.path.getsize(data_filepath) - data_size
+    else:
+        offset += header_size
 
-    return meta_dict
+    return data_filepath, data_type, shape, offset
 
 
-def load_mhd(file_path):
+def load_mhd(file_path, mmap_mode=None):
     """
     Loads an mhd file at file_path.
 
     Returns a tuple: (image_data, meta_dict)
         containing a numpy array with the image data, and a dict
         containing the meta information in the mhd file
-    """
-    meta_dict = load_mhd_header(file_path)
-    data_dimensions = map(int, meta_dict['DimSize'].split())
 
-    image_dir = os.path.dirname(file_path)
-    data_filepath = os.path.join(image_dir, meta_dict['ElementDataFile'])
-    data_type = data_type_key[meta_dict['ElementType'].upper()]
+    If mmap_mode is given ('r', 'r+' or 'c', see numpy.memmap) the image data is memory mapped rather than read
+        into memory, so only the parts of the image that are accessed are loaded.  Memory mapped arrays keep the
+        byte order of the data file, otherwise arrays are returned in native byte order
 
-    image_data = numpy.fromfile(data_filepath, dtype=data_type)
-    image_data = numpy.reshape(image_data, data_dimensions, order='F')
+    Compressed (CompressedData = True) files are decompressed as they're read, straight into the returned array.
+        They can't be memory mapped, so they're always loaded into memory
+    """
+    meta_dict, header_length = _read_mhd_header(file_path)
+    data_filepath, data_type, shape, offset = _get_mhd_data_layout(file_path, meta_dict, header_length)
+
+    if _is_compressed(meta_dict):
+        if mmap_mode is not None:
+            warn('Compressed mhd files can not be memory mapped, loading %s into memory' % file_path)
+        compressed_size = int(meta_dict['CompressedDataSize']) if 'CompressedDataSize' in meta_dict else None
+        image_data = _read_compressed_data(data_filepath, data_type, shape, offset, compressed_size)
+    elif mmap_mode is not None:
+        image_data = numpy.memmap(data_filepath, dtype=data_type, mode=mmap_mode, shape=shape, offset=offset, order='F')
+    else:
+        with open(data_filepath, 'rb') as data_file:
+            data_file.seek(offset)
+            image_data = numpy.fromfile(data_file, dtype=data_type, count=int(numpy.prod(shape)))
+        image_data = numpy.reshape(image_data, shape, order='F')
+        if not image_data.dtype.isnative:
+            image_data = image_data.byteswap(True).newbyteorder()
 
     return image_data, meta_dict
 
 
+# Caches used by load_mhd_cached.  Set mhd_cache.max_bytes to change the memory budget of the image data cache
+mhd_cache = caching.LRUCache(max_items=None, max_bytes=2**30)
+mhd_header_cache = caching.LRUCache(max_items=4096)
+
+
+def load_mhd_cached(file_path):
+    """
+    Loads an mhd file like load_mhd, keeping the image data in a process wide, memory budgeted LRU cache (mhd_cache),
+     and the parsed header in mhd_header_cache
+
+    Files are cached by their absolute path, modification time and size (and those of their data file),
+     so files that are rewritten are loaded again.  Cached image data is shared, so it's returned read only
+
+    Returns a tuple: (image_data, meta_dict)
+    """
+    file_path = os.path.abspath(file_path)
+    file_stat = os.stat(file_path)
+    meta_dict, header_length = mhd_header_cache.get_or_compute(
+        (file_path, file_stat.st_mtime, file_stat.st_size),
+        lambda: _read_mhd_header(file_path)
+    )
+
+    data_filepath = _get_mhd_data_layout(file_path, meta_dict, header_length)[0]
+    data_stat = os.stat(data_filepath)
+    image_data = mhd_cache.get_or_compute(
+        (file_path, file_stat.st_mtime, file_stat.st_size, data_stat.st_mtime, data_stat.st_size),
+        lambda: _load_read_only_mhd(file_path)
+    )
+
+    return image_data, dict(meta_dict)
+
+
+def _load_read_only_mhd(file_path):
+    image_data = load_mhd(file_path)[0]
+    image_data.flags.writeable = False
+    return image_data
+
+
+def _is_compressed(meta_dict):
+    return meta_dict.get('CompressedData', 'False').lower() == 'true'
+
+
+def _read_compressed_data(data_filepath, data_type, shape, offset, compressed_size=None,
+                          read_size=2**20, max_piece_size=2**22):
+    """
+    Decompresses zlib compressed image data into a preallocated fortran ordered array, a piece at a time, so
+     neither the compressed nor the decompressed data is ever held in memory in full besides the array itself
+
+    :param compressed_size: The number of compressed bytes to read, the rest of the file is read if None
+    :return: The image data, in native byte order
+    """
+    image_data = numpy.empty(shape, dtype=data_type, order='F')
+    output = image_data.reshape(-1, order='F').view(numpy.uint8)
+
+    decompressor = zlib.decompressobj()
+    position = 0
+
+    def write_piece(piece):
+        if position + len(piece) > len(output):
+            raise ValueError('%s holds more data than it\'s DimSize and ElementType describe' % data_filepath)
+        output[position:position + len(piece)] = numpy.frombuffer(piece, dtype=numpy.uint8)
+        return position + len(piece)
+
+    with open(data_filepath, 'rb') as data_file:
+        data_file.seek(offset)
+        remaining = compressed_size
+        while remaining is None or remaining > 0:
+            chunk = data_file.read(read_size if remaining is None else min(read_size, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+
+            # Limiting the size of each decompressed piece bounds memory use for very compressible data
+            while chunk:
+                position = write_piece(decompressor.decompress(chunk, max_piece_size))
+                chunk = decompressor.unconsumed_tail
+
+        position = write_piece(decompressor.flush())
+
+    if position != len(output):
+        raise ValueError('%s holds less data than it\'s DimSize and ElementType describe' % data_filepath)
+
+    if not image_data.dtype.isnative:
+        image_data = image_data.byteswap(True).newbyteorder()
+    return image_data
+
+
+def load_mhd_region(file_path, region):
+    """
+    Loads part of the image in an mhd file, only reading the pages of the data file that hold it
+
+    Images are stored with their first axis varying fastest, so regions that span few indices along the last
+     axis (e.g. a single coronal slice of an atlas volume) are read fastest
+
+    Compressed files can't be read in part, the whole image is decompressed and the region copied out of it
+
+    :param file_path: The path to the mhd file
+    :param region: A tuple of slices or indices, one per dimension, as used to index the image's array
+    :return: A tuple (image_data, meta_dict), image_data is an in memory copy of the region in native byte order
+    """
+    mmap_mode = None if _is_compressed(load_mhd_header(file_path)) else 'r'
+    image_data, meta_dict = load_mhd(file_path, mmap_mode=mmap_mode)
+    region_data = numpy.array(image_data[region])
+    if not region_data.dtype.isnative:
+        region_data = region_data.byteswap(True).newbyteorder()
+    return region_data, meta_dict
+
+
 def write_meta_header(file_path, meta_dict):
     header = ''
     # Tag order matters here so I can't just iterate through meta_dict.keys()
@@ -223,31 +1457,325 @@ def write_meta_header(file_path, meta_dict):
     f.close()
 
 
-def dump_raw_data(file_path, data):
-    """ Write the data into a raw format file. Big endian is always used. """
-    # TODO: THIS
-    rawfile = open(file_path,'wb')
-    a = array.array('f')
-    for o in data:
-        a.fromlist(list(o))
-    #if is_little_endian():
-    #    a.byteswap()
-    a.tofile(rawfile)
-    rawfile.close()
+def get_element_type(dtype):
+    """
+    Returns the ElementType tag for a numpy dtype, looked up by the type's kind and size,
+     since e.g. numpy.int64 and numpy.longlong are equivalent but distinct types
+    """
+    dtype = numpy.dtype(dtype).newbyteorder('=')
+    for numpy_type, element_type in data_type_key.iteritems():
+        if not isinstance(numpy_type, basestring) and numpy.dtype(numpy_type) == dtype:
+            return element_type
+    raise ValueError('Arrays of type %s can not be written to mhd files' % dtype)
+
+
+def dump_raw_data(file_path, data, compress=False):
+    """
+    Write the data into a raw format file, in fortran order and in the data's byte order, see write_mhd
+
+    Returns the number of bytes written
+    """
+    data = numpy.asarray(data)
+    return _write_raw_slabs(file_path, _split_into_slabs(data), data.shape, data.dtype, compress)
+
+
+def write_mhd(output_path, image_data, compress=False, **kwargs):
+    """
+    Writes an array to an mhd file at output_path, and it's data to a raw file next to it
+
+    The array's buffer is written directly, in it's own element type and byte order.  Arrays that aren't fortran
+     contiguous are converted a slab at a time, so writing never needs a second copy of the whole array
+
+    :param output_path: The path of the .mhd file
+    :param image_data: A numpy array
+    :param compress: If True the data is zlib compressed, and written to a .zraw file
+    :param kwargs: Additional header tags, e.g. ElementSpacing='25 25 25'
+    """
+    image_data = numpy.asarray(image_data)
+    write_mhd_slabs(output_path, _split_into_slabs(image_data), image_data.shape, image_data.dtype,
+                    compress=compress, **kwargs)
+
+
+def write_mhd_slabs(output_path, slabs, shape, dtype, compress=False, **kwargs):
+    """
+    Writes an image to an mhd file a slab at a time, e.g. from a generator, so the whole image is never in memory
+
+    Slabs are consecutive ranges of the image along it's last axis, which varies slowest in mhd files.  Each slab's
+     shape is shape[:-1] followed by it's length along the last axis, or just shape[:-1] for a single plane.
+     The header is written after the data, so an mhd file only exists once it's data is complete
+
+    :param output_path: The path of the .mhd file
+    :param slabs: An iterable of arrays
+    :param shape: The shape of the whole image
+    :param dtype: The dtype the image is written with, slabs of other types are converted
+    :param compress: If True the data is zlib compressed, and written to a .zraw file
+    :param kwargs: Additional header tags, e.g. ElementSpacing='25 25 25'
+    """
+    dtype = numpy.dtype(dtype)
+    data_filename = os.path.splitext(os.path.basename(output_path))[0] + ('.zraw' if compress else '.raw')
+    data_filepath = os.path.join(os.path.dirname(output_path), data_filename)
+
+    num_bytes = _write_raw_slabs(data_filepath, slabs, shape, dtype, compress)
+
+    msb = dtype.byteorder == '>' or (dtype.byteorder == '=' and sys.byteorder == 'big')
+    metadata = {'ObjectType': 'Image',
+                'NDims': str(len(shape)),
+                'BinaryData': 'True',
+                'BinaryDataByteOrderMSB': str(msb),
+                'CompressedData': str(compress),
+                'DimSize': ' '.join(map(str, shape)),
+                'ElementType': get_element_type(dtype),
+                'ElementDataFile': data_filename}
+    if compress:
+        metadata['CompressedDataSize'] = str(num_bytes)
+    metadata.update(kwargs)
+
+    write_meta_header(output_path, metadata)
+
+
+def _split_into_slabs(image_data, max_slab_bytes=2**26):
+    """
+    Yields views of image_data along it's last axis, of at most max_slab_bytes (or a single index along the last axis)
+    """
+    if image_data.ndim == 0:
+        yield image_data.reshape(1)
+        return
+
+    plane_bytes = max(image_data.nbytes // max(image_data.shape[-1], 1), 1)
+    slab_length = max(max_slab_bytes // plane_bytes, 1)
+    for start in xrange(0, image_data.shape[-1], slab_length):
+        yield image_data[..., start:start + slab_length]
+
+
+def _write_raw_slabs(file_path, slabs, shape, dtype, compress=False):
+    """
+    Writes slabs of an image (see write_mhd_slabs) to a raw file, zlib compressed if compress is True
+
+    Returns the number of bytes written
+    """
+    shape = tuple(shape)
+    compressor = zlib.compressobj() if compress else None
+
+    num_bytes = 0
+    length = 0
+    with open(file_path, 'wb') as raw_file:
+        for slab in slabs:
+            slab = numpy.asarray(slab, dtype=dtype)
+            if len(shape) > 0 and slab.shape == shape[:-1]:
+                slab = slab[..., numpy.newaxis]
+            if slab.shape[:-1] != shape[:-1]:
+                raise ValueError('Slabs of an image with shape %s can not have shape %s' % (shape, slab.shape))
+            length += slab.shape[-1]
+
+            # A view for fortran contiguous slabs, only the slab is copied otherwise
+            slab_buffer = numpy.ravel(slab, order='F').data
+            if compressor is not None:
+                slab_buffer = compressor.compress(slab_buffer)
+            raw_file.write(slab_buffer)
+            num_bytes += len(slab_buffer)
+
+        if compressor is not None:
+            tail = compressor.flush()
+            raw_file.write(tail)
+            num_bytes += len(tail)
+
+    if len(shape) > 0 and length != shape[-1]:
+        raise ValueError('Slabs of an image with shape %s only spanned %d indices along it\'s last axis'
+                         % (shape, length))
+
+    return num_bytes
+
+
+## LABEL MAP STORE
+
+# Label map stores are framed like serialized records (see serialization.pack_frame), with their own magic: the magic,
+#  the format version and the length of a json index of the maps they hold, followed by the aligned map data
+_label_map_magic = '\x00EHL'
+label_map_format_version = 1
+
+
+class LabelMapStore(object):
+    """
+    Reads the registered atlas label maps and hemisphere maps of an experiment from a single file written by
+     pack_label_maps, so loading the maps of every image takes one open and one memory map, rather than opening
+     an mhd and a raw file per map
+
+    The file starts with a json index mapping each image's vsiPath to the dtype, shape and offset of it's maps,
+     followed by the maps themselves in fortran order and native byte order.  Maps are returned as read only views of
+     the memory mapped file
+
+    If validate is True, the maps of an image are only read from the store if their mhd files haven't changed since
+     they were packed (see has_current_maps), which takes a stat of each mhd file
+    """
+
+    # The metadata attributes holding the path to each map's mhd file, relative to the experiment path
+    map_path_keys = (('region_map', 'registeredAtlasLabelsPath'),
+                     ('hemisphere_map', 'registeredHemisphereLabelsPath'))
+
+    def __init__(self, store_path, validate=True):
+        self.store_path = store_path
+        self.validate = validate
+
+        with open(store_path, 'rb') as store_file:
+            prefix = store_file.read(serialization.prefix_size)
+            if len(prefix) < serialization.prefix_size or not prefix.startswith(_label_map_magic):
+                raise ValueError('%s is not a label map store' % store_path)
+
+            magic, version, header_length = serialization.unpack_frame(prefix)
+            if version > label_map_format_version:
+                raise ValueError('%s was written with format version %d, only versions up to %d can be read'
+                                 % (store_path, version, label_map_format_version))
+            self._index = json.loads(store_file.read(header_length))['maps']
+
+        self._body_start = serialization.get_body_offset(header_length)
+        self._data = numpy.memmap(store_path, dtype=numpy.uint8, mode='r')
+
+    @staticmethod
+    def generate_store_path(experiment_path):
+        """
+        Generates the default path of an experiment's label map store: 'experimentPath/.registrationData/label_maps.pack'
+        """
+        return os.path.join(experiment_path, '.registrationData', 'label_maps.pack')
+
+    @classmethod
+    def open_for_experiment(cls, experiment_path, validate=True):
+        """
+        Opens the label map store at the default path for experiment_path, returns None if there isn't one
+        """
+        store_path = cls.generate_store_path(experiment_path)
+        if not os.path.exists(store_path):
+            return None
+        return cls(store_path, validate)
+
+    def __contains__(self, vsi_path):
+        return vsi_path in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def get_vsi_paths(self):
+        return [str(vsi_path) for vsi_path in self._index]
+
+    def has_current_maps(self, metadata, experiment_path):
+        """
+        Returns True if the store holds the maps that the metadata entry's registration results point to, and, if
+         self.validate is True, the mhd files of those maps haven't changed (by modification time and size) since
+         they were packed.  Mhd files are rewritten along with their data files, so only they are checked
+        """
+        maps = self._index.get(metadata.get('vsiPath'))
+        if maps is None:
+            return False
+
+        for map_name, path_key in self.map_path_keys:
+            map_info = maps[map_name]
+            if map_info['source'] != metadata.get(path_key):
+                return False
+
+            # Registration is usually rerun in place, overwriting the files that were packed
+            if self.validate:
+                try:
+                    source_stat = _get_file_stat(os.path.join(experiment_path, map_info['source']))
+                except OSError:
+                    return False
+                if source_stat != map_info.get('source_stat'):
+                    return False
+
+        return True
+
+    def get_maps(self, vsi_path):
+        """
+        Returns a tuple (region_map, hemisphere_map) of read only arrays for the image at vsi_path
+
+        Raises a KeyError if the store doesn't hold the image's maps
+        """
+        maps = self._index[vsi_path]
+        return tuple(self._get_map(maps[map_name]) for map_name, path_key in self.map_path_keys)
+
+    def _get_map(self, map_info):
+        dtype = numpy.dtype(str(map_info['dtype']))
+        shape = tuple(map_info['shape'])
+        start = self._body_start + map_info['offset']
+        num_bytes = int(numpy.prod(shape)) * dtype.itemsize
+        return self._data[start:start + num_bytes].view(dtype).reshape(shape, order='F')
+
+
+def load_label_maps(metadata, experiment_path, label_map_store=None):
+    """
+    Loads the registered atlas label map and hemisphere map of a metadata entry.  The maps are read from
+     label_map_store if it holds the entry's current maps (see LabelMapStore.has_current_maps), and with
+     load_mhd_cached otherwise, so they're read only
+
+    :return: A tuple (region_map, hemisphere_map)
+    """
+    if label_map_store is not None and label_map_store.has_current_maps(metadata, experiment_path):
+        return label_map_store.get_maps(metadata['vsiPath'])
+
+    return tuple(load_mhd_cached(os.path.join(experiment_path, metadata[path_key]))[0]
+                 for map_name, path_key in LabelMapStore.map_path_keys)
+
+
+def pack_label_maps(store_path, metadata, experiment_path):
+    """
+    Packs the registered atlas label maps and hemisphere maps of the entries in metadata into a single file at
+     store_path, to be read with a LabelMapStore.  The store is replaced atomically, so readers never see a
+     partially written store
+
+    The modification time and size of each map's mhd file are recorded, so that maps which are rewritten after
+     they're packed are loaded from their files again.  Entries whose maps can't be found
+     (usually because registration failed) are skipped
+
+    :return: A tuple (packed, skipped) of lists of the vsiPaths of packed and skipped entries
+    """
+    index = dict()
+    sources = list()
+    skipped = list()
+    offset = 0
+
+    # The index is built from the mhd headers, so the maps can be copied into place one at a time
+    for entry in metadata:
+        try:
+            maps = dict()
+            entry_sources = list()
+            entry_offset = offset
+            for map_name, path_key in LabelMapStore.map_path_keys:
+                mhd_path = os.path.join(experiment_path, entry[path_key])
+                mhd_stat = _get_file_stat(mhd_path)
+                meta_dict, header_length = _read_mhd_header(mhd_path)
+                data_filepath, data_type, shape = _get_mhd_data_layout(mhd_path, meta_dict, header_length)[:3]
+                if not os.path.exists(data_filepath):
+                    raise IOError('Data file %s does not exist' % data_filepath)
+
+                data_type = data_type.newbyteorder('=')
+                entry_offset = serialization.align(entry_offset)
+                maps[map_name] = {
+                    'dtype': data_type.str,
+                    'shape': shape,
+                    'offset': entry_offset,
+                    'source': entry[path_key],
+                    'source_stat': mhd_stat
+                }
+                entry_sources.append((mhd_path, maps[map_name]))
+                entry_offset += int(numpy.prod(shape)) * data_type.itemsize
+
+            index[entry['vsiPath']] = maps
+        except (IOError, OSError, KeyError, ValueError):
+            skipped.append(entry.get('vsiPath'))
+            continue
 
+        sources += entry_sources
+        offset = entry_offset
 
-def write_mhd(output_path, image_data, **kwargs):
-     metadata = {'ObjectType': 'Image',
-                 'BinaryData': 'True',
-                 'BinaryDataByteOrderMSB': 'False',
-                 'ElementType': data_type_key[image_data.dtype],
-                 'NDims': str(image_data.ndim),
-                 'DimSize': ' '.join(image_data.shape),
-                 'ElementDataFile': os.path.basename(output_path).replace('.mhd','.raw')}
+    header = json.dumps({'maps': index}, sort_keys=True)
+    body_start = serialization.get_body_offset(len(header))
 
-     write_meta_header(output_path, metadata)
-     output_dir = os.path.dirname((output_path))
-     data_filepath = os.path.join(output_dir, metadata['ElementDataFile'])
-     dump_raw_data(data_filepath, image_data)
+    with files.open_atomically(store_path, 'wb') as store_file:
+        store_file.write(serialization.pack_frame(_label_map_magic, label_map_format_version, header))
+        for mhd_path, map_info in sources:
+            image_data = load_mhd(mhd_path)[0]
+            if image_data.shape != tuple(map_info['shape']):
+                raise ValueError('%s changed while it was being packed' % mhd_path)
 
+            store_file.seek(body_start + map_info['offset'])
+            store_file.write(numpy.ravel(image_data, order='F').data)
 
+    return sorted(index), skipped
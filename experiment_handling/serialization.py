@@ -0,0 +1,291 @@
+import json
+import struct
+import numpy
+import data
+
+
+# Serialized records start with this magic, the format version, and the length of a json header.  The header describes
+#  the record's fields, and the arrays that follow it as raw buffers.  Records never start like pickles or like
+#  compressed records (see io.encode_record), so all three can be told apart
+_magic = '\x00EHS'
+_prefix_struct = struct.Struct('<4sBI')
+
+# The version of the format written by dumps.  Increment this when the format changes, loads reads all older versions
+format_version = 1
+
+# Array buffers are aligned to this many bytes within a record
+_alignment = 16
+
+# The size of the magic, version and header length that start a record
+prefix_size = _prefix_struct.size
+
+
+def is_serialized(record):
+    """
+    Returns True if record was written by dumps
+    """
+    return record.startswith(_magic)
+
+
+def dumps(obj):
+    """
+    Serializes obj to a string.  obj may be an ImageDescriptor, a list of PhysicalCells, a cell table
+     (see ImageDescriptor.get_cell_table) or a numpy array without objects
+
+    ImageDescriptors are stored with their source_path, depth, vsi_resolution, region map scale and offset, maps,
+     map keys and cells.  PhysicalCells are stored with their image, mask, centroid, bounding box and pixel scale
+    """
+    if isinstance(obj, data.ImageDescriptor):
+        kind, fields, arrays = 'image_descriptor', _get_descriptor_fields(obj), _get_descriptor_arrays(obj)
+    elif isinstance(obj, numpy.ndarray):
+        kind, fields, arrays = 'array', {}, [('array', obj)]
+    elif isinstance(obj, dict) and sorted(obj) == ['cells', 'depth', 'source_path', 'vsi_resolution']:
+        kind = 'cell_table'
+        fields = dict((name, obj[name]) for name in ('source_path', 'depth', 'vsi_resolution'))
+        arrays = [('cells', obj['cells'])]
+    elif isinstance(obj, list) and all(isinstance(cell, data.PhysicalCell) for cell in obj):
+        kind, fields, arrays = 'cells', {'count': len(obj)}, _get_cell_arrays(obj, 'cells.')
+    else:
+        raise TypeError('Objects of type %s can not be serialized' % type(obj).__name__)
+
+    return _pack(kind, fields, arrays)
+
+
+def loads(record):
+    """
+    Deserializes a string written by dumps.  The returned object's arrays share a single writable buffer
+    """
+    magic, version, header_length = unpack_frame(record)
+    if magic != _magic:
+        raise ValueError('Not a serialized record')
+    if version > format_version:
+        raise ValueError('Record was written with format version %d, only versions up to %d can be read'
+                         % (version, format_version))
+
+    header = json.loads(record[prefix_size:prefix_size + header_length])
+    body_start = get_body_offset(header_length)
+
+    # A single copy of the record gives all of it's arrays writable memory
+    buf = bytearray(record)
+    arrays = dict()
+    for name, descr, shape, offset in header['arrays']:
+        dtype = _dtype_from_descr(descr)
+        count = int(numpy.prod(shape))
+        if count == 0:
+            arrays[name] = numpy.empty(shape, dtype=dtype)
+        else:
+            arrays[name] = numpy.frombuffer(buf, dtype=dtype, count=count, offset=body_start + offset).reshape(shape)
+
+    return _decoders[header['kind']](header['fields'], arrays)
+
+
+def _pack(kind, fields, arrays):
+    """
+    Writes a record containing fields, a json serializable dict, and arrays, a list of (name, array) tuples
+    """
+    array_headers = list()
+    buffers = list()
+    offset = 0
+    for name, array in arrays:
+        array = numpy.ascontiguousarray(array)
+        if array.dtype.hasobject:
+            raise TypeError('Array %s contains objects, which can not be serialized' % name)
+
+        offset = align(offset)
+        array_headers.append((name, _dtype_to_descr(array.dtype), array.shape, offset))
+        buffers.append((offset, array.tostring()))
+        offset += array.nbytes
+
+    # Keys are sorted so that equal objects are serialized identically
+    header = json.dumps({'kind': kind, 'fields': fields, 'arrays': array_headers}, default=_to_json, sort_keys=True)
+
+    chunks = [pack_frame(_magic, format_version, header)]
+    position = 0
+    for buffer_offset, array_buffer in buffers:
+        chunks.append('\x00' * (buffer_offset - position))
+        chunks.append(array_buffer)
+        position = buffer_offset + len(array_buffer)
+
+    return ''.join(chunks)
+
+
+def pack_frame(magic, version, header):
+    """
+    Frames a header the way records are framed: a 4 byte magic, a version byte and the header's length, the header,
+     then padding up to the alignment of the data that follows it.  Other formats (e.g. io.LabelMapStore) use this
+     with their own magic
+
+    Returns the framed header, data follows it at get_body_offset(len(header))
+    """
+    prefix = _prefix_struct.pack(magic, version, len(header)) + header
+    return prefix + '\x00' * (get_body_offset(len(header)) - len(prefix))
+
+
+def unpack_frame(prefix):
+    """
+    Returns a tuple (magic, version, header_length) from the first prefix_size bytes of a framed header.  The header
+     itself follows at prefix_size
+    """
+    return _prefix_struct.unpack_from(prefix)
+
+
+def get_body_offset(header_length):
+    """
+    Returns the offset of the data that follows a framed header of header_length bytes
+    """
+    return align(prefix_size + header_length)
+
+
+def align(offset):
+    """
+    Rounds offset up to the alignment of array buffers
+    """
+    return -(-offset // _alignment) * _alignment
+
+
+def _to_json(value):
+    if isinstance(value, numpy.generic):
+        return value.item()
+    if isinstance(value, numpy.ndarray):
+        return value.tolist()
+    raise TypeError('%r is not json serializable' % value)
+
+
+def _to_str(value):
+    # json returns unicode strings, paths and keys are stored as str elsewhere
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _dtype_to_descr(dtype):
+    if dtype.names is None:
+        return dtype.str
+    return dtype.descr
+
+
+def _dtype_from_descr(descr):
+    if isinstance(descr, basestring):
+        return numpy.dtype(str(descr))
+
+    fields = list()
+    for field in descr:
+        name, field_descr = str(field[0]), field[1]
+        if isinstance(field_descr, basestring):
+            field_descr = str(field_descr)
+        else:
+            field_descr = _dtype_from_descr(field_descr)
+
+        if len(field) > 2:
+            fields.append((name, field_descr, tuple(field[2])))
+        else:
+            fields.append((name, field_descr))
+    return numpy.dtype(fields)
+
+
+def _get_descriptor_fields(descriptor):
+    return {
+        'source_path': descriptor.source_path,
+        'depth': descriptor.depth,
+        'vsi_resolution': descriptor.vsi_resolution,
+        'region_map_scale': descriptor.region_map_scale,
+        'region_map_offset': descriptor.region_map_offset,
+        'region_map_key': descriptor.get_map_key('region_map'),
+        'hemisphere_map_key': descriptor.get_map_key('hemisphere_map'),
+        'cell_count': len(descriptor.cells)
+    }
+
+
+def _get_descriptor_arrays(descriptor):
+    arrays = list()
+    for map_name in ('region_map', 'hemisphere_map'):
+        # Maps stored in an image database are only referenced by their key
+        if descriptor.get_map_key(map_name) is None:
+            map_array = getattr(descriptor, map_name)
+            if map_array is not None:
+                arrays.append((map_name, numpy.asarray(map_array)))
+
+    return arrays + _get_cell_arrays(descriptor.cells, 'cells.')
+
+
+def _get_cell_arrays(cells, prefix):
+    """
+    Packs the images and masks of cells into one flat array each, along with the shape of each cell's image and mask
+    """
+    if not cells:
+        return []
+
+    images = [numpy.asarray(cell.image) for cell in cells]
+    masks = [numpy.asarray(cell.mask) for cell in cells]
+    return [
+        (prefix + 'images', numpy.concatenate([image.ravel() for image in images])),
+        (prefix + 'image_shapes', _get_shapes(images)),
+        (prefix + 'masks', numpy.concatenate([mask.ravel() for mask in masks])),
+        (prefix + 'mask_shapes', _get_shapes(masks)),
+        (prefix + 'centroids', numpy.asarray([cell.centroid for cell in cells])),
+        (prefix + 'bboxes', numpy.asarray([cell.bbox for cell in cells])),
+        (prefix + 'pixel_scales', numpy.asarray([cell.pixel_scale for cell in cells], dtype=numpy.float64))
+    ]
+
+
+def _get_shapes(arrays):
+    if len(set(array.ndim for array in arrays)) > 1:
+        raise ValueError('Every cell must have the same number of image and mask dimensions')
+    return numpy.asarray([array.shape for array in arrays], dtype=numpy.int64)
+
+
+def _split(flat, shapes):
+    ends = numpy.cumsum(numpy.prod(shapes, axis=1))
+    starts = ends - numpy.prod(shapes, axis=1)
+    return [flat[start:end].reshape(shape) for start, end, shape in zip(starts, ends, shapes.tolist())]
+
+
+def _load_cells(count, arrays, prefix):
+    if count == 0:
+        return list()
+
+    images = _split(arrays[prefix + 'images'], arrays[prefix + 'image_shapes'])
+    masks = _split(arrays[prefix + 'masks'], arrays[prefix + 'mask_shapes'])
+    centroids = arrays[prefix + 'centroids']
+    bboxes = arrays[prefix + 'bboxes'].tolist()
+    pixel_scales = arrays[prefix + 'pixel_scales'].tolist()
+
+    return [data.PhysicalCell(image, mask, centroid, pixel_scale, bounding_box=tuple(bbox))
+            for image, mask, centroid, bbox, pixel_scale in zip(images, masks, centroids, bboxes, pixel_scales)]
+
+
+def _load_image_descriptor(fields, arrays):
+    descriptor = data.ImageDescriptor(
+        source_path=_to_str(fields['source_path']),
+        region_map=arrays.get('region_map'),
+        hemisphere_map=arrays.get('hemisphere_map'),
+        depth=fields['depth'],
+        region_map_scale=fields['region_map_scale'],
+        region_map_offset=fields['region_map_offset'],
+        cells=_load_cells(fields['cell_count'], arrays, 'cells.')
+    )
+    descriptor.vsi_resolution = fields['vsi_resolution']
+
+    for map_name in ('region_map', 'hemisphere_map'):
+        map_key = fields[map_name + '_key']
+        if map_key is not None:
+            descriptor.set_map_key(map_name, _to_str(map_key))
+
+    return descriptor
+
+
+def _load_cell_table(fields, arrays):
+    return {
+        'source_path': _to_str(fields['source_path']),
+        'depth': fields['depth'],
+        'vsi_resolution': tuple(fields['vsi_resolution']),
+        'cells': arrays['cells']
+    }
+
+
+_decoders = {
+    'image_descriptor': _load_image_descriptor,
+    'cells': lambda fields, arrays: _load_cells(fields['count'], arrays, 'cells.'),
+    'cell_table': _load_cell_table,
+    'array': lambda fields, arrays: arrays['array']
+}